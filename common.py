@@ -21,28 +21,143 @@ There is quite a lot of overlap between the ansible-gerrit modules. It makes
 sense to have a set of common code in a separate file, to avoid duplication.
 
 Ansible modules need to be self-contained Python files. In order to insert the
-code from this file into each of the modules, use `cat` to join the two files
-together. There is a Makefile included in the repo that does this.
+code from this file into each of the modules, run `make`. The Makefile uses
+tools/build_module.py, which copies only the parts of this file that each
+module actually uses.
+
+Every module runs in a fresh Python interpreter for every task, so importing
+modules we don't need is a real cost. Heavy dependencies like pygerrit and
+requests are therefore imported lazily, on the code paths that need them.
+For the same reason, code that only some tasks use, like snapshot support,
+is referred to through lazy_definition(), and is only compiled when it's
+needed.
 
 '''
 
 
-import pygerrit.rest
-import requests.auth
+# Used to measure how long it takes to import everything a module needs, so
+# it's set before anything else is imported.
+import time
+MODULE_START_TIME = time.time()
 
+import array
+import atexit
+import binascii
+import codecs
+import contextlib
+import copy
+import fcntl
+import hashlib
+import hmac
+import importlib
 import json
 import logging
 import os
+import re
+import tempfile
+import threading
 import urllib
 
+try:
+    intern
+except NameError:
+    from sys import intern
+
+
+class LazyModule(object):
+    '''Import a module the first time one of its attributes is used.'''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Importing 'requests' also imports requests.auth and requests.exceptions.
+requests = LazyModule('requests')
+
+
+# Set by tools/build_module.py to the source of the definitions that only some
+# tasks need, such as the snapshot and cache support. Compiling them is left
+# until lazy_definition() asks for one of them.
+LAZY_SOURCE = None
+
+
+def lazy_definition(name):
+    '''Return the top-level definition 'name', compiling it if need be.
+
+    Refer to optional parts of this file through this function rather than
+    by name, so that tools/build_module.py knows they can be left out of the
+    eagerly compiled part of each module.
+
+    '''
+    global LAZY_SOURCE
+    if name not in globals() and LAZY_SOURCE is not None:
+        code = compile(LAZY_SOURCE, '<lazy definitions>', 'exec')
+        LAZY_SOURCE = None
+        exec(code, globals())
+    return globals()[name]
+
 
 GERRIT_COMMON_ARGUMENTS = dict(
     gerrit_url            = dict(type='str'),
     gerrit_admin_username = dict(type='str'),
-    gerrit_admin_password = dict(type='str')
+    gerrit_admin_password = dict(type='str'),
+
+    # Path to the Unix socket of a running tools/gerrit_worker.py process. If
+    # set, the task is forwarded to the worker instead of being run here.
+    gerrit_worker_socket  = dict(type='str'),
+
+    # Directory for a cache of GET responses that is shared between all tasks
+    # running on this host. Identical concurrent reads are only sent to Gerrit
+    # once, and responses are reused for 'gerrit_cache_ttl' seconds unless a
+    # task writes something to Gerrit in the meantime.
+    gerrit_cache_dir      = dict(type='str'),
+    gerrit_cache_ttl      = dict(type='int', default=60),
+
+    # A snapshot file made by tools/gerrit_snapshot.py. GET requests for
+    # anything in the snapshot are answered from it instead of from Gerrit.
+    # Loading a big snapshot takes a while, so this works best together with
+    # 'gerrit_worker_socket', where it is only loaded once.
+    gerrit_snapshot       = dict(type='str'),
+
+    # A file of Gerrit events, as written by `gerrit stream-events`. Objects
+    # that changed since the snapshot was last refreshed are read from Gerrit
+    # rather than from 'gerrit_snapshot'.
+    gerrit_events         = dict(type='str'),
+)
+
+
+LOGGING_ARGUMENTS = dict(
+    # File to append the module's log to. Nothing is logged unless this (or
+    # GERRIT_LOG_FILE in the environment) is set.
+    log_file              = dict(type='str'),
+
+    # How much to log. Can also be set with GERRIT_LOG_LEVEL. The default is
+    # 'info'.
+    log_level             = dict(type='str', choices=['debug', 'info',
+                                                      'warning', 'error']),
+)
+
+
+PROFILE_ARGUMENTS = dict(
+    # Return how long each phase of the task took, in the 'profile' field of
+    # the task's result.
+    profile               = dict(type='bool', default=False),
+
+    # Also save cProfile statistics (and, on Python 3, a tracemalloc summary)
+    # for each task to files in this directory. Implies 'profile'.
+    profile_dir           = dict(type='str'),
 )
 
 
+GERRIT_MAGIC_JSON_PREFIX = ")]}'"
+
+
 class AnsibleGerritError(Exception):
     pass
 
@@ -51,36 +166,819 @@ def quote(name):
     return urllib.quote(name, safe="")
 
 
+def unquote(name):
+    return urllib.unquote(name)
+
+
+def decode_response(response):
+    '''Check for errors and decode the JSON content of a Gerrit response.
+
+    Empty responses (such as '204 No Content') decode to ''. Content that
+    isn't JSON is returned as-is.
+
+    '''
+    response.raise_for_status()
+    content = response.text.strip()
+    if content.startswith(GERRIT_MAGIC_JSON_PREFIX):
+        content = content[len(GERRIT_MAGIC_JSON_PREFIX):].lstrip()
+    if len(content) == 0:
+        return ''
+    try:
+        return json.loads(content)
+    except ValueError:
+        logging.debug("Response from %s is not JSON", response.url)
+        return content
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_items(chunks):
+    '''Incrementally decode a JSON list or object from chunks of text.
+
+    The items of a top-level list are yielded one at a time, as soon as
+    enough text has arrived to decode them. For a top-level object, (key,
+    value) pairs are yielded. Gerrit's ")]}'" prefix is skipped.
+
+    '''
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+
+    def read_more():
+        try:
+            return next(chunks)
+        except StopIteration:
+            return None
+
+    def skip(buf, pos, chars):
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+        return pos
+
+    # Read enough to strip the prefix and find the opening bracket.
+    while len(buf.lstrip()) <= len(GERRIT_MAGIC_JSON_PREFIX):
+        chunk = read_more()
+        if chunk is None:
+            break
+        buf += chunk
+    buf = buf.lstrip()
+    if buf.startswith(GERRIT_MAGIC_JSON_PREFIX):
+        buf = buf[len(GERRIT_MAGIC_JSON_PREFIX):]
+    buf = buf.lstrip()
+    while len(buf) == 0:
+        chunk = read_more()
+        if chunk is None:
+            return
+        buf = chunk.lstrip()
+
+    if buf[0] == '[':
+        is_object = False
+        closing = ']'
+    elif buf[0] == '{':
+        is_object = True
+        closing = '}'
+    else:
+        raise ValueError("Expected a JSON list or object, got: %s" % buf[:20])
+    pos = 1
+
+    while True:
+        pos = skip(buf, pos, ' \t\r\n,')
+        if pos < len(buf) and buf[pos] == closing:
+            return
+
+        try:
+            if is_object:
+                key, end = decoder.raw_decode(buf, pos)
+                end = skip(buf, end, ' \t\r\n')
+                if end >= len(buf) or buf[end] != ':':
+                    raise ValueError("Incomplete key")
+                end = skip(buf, end + 1, ' \t\r\n')
+                value, end = decoder.raw_decode(buf, end)
+                item = (key, value)
+            else:
+                item, end = decoder.raw_decode(buf, pos)
+
+            # A complete item is always followed by a separator, a closing
+            # bracket or whitespace. Otherwise, a number that's split across
+            # two chunks, such as 12|3 or 1.|5, could be decoded as 12 or 1.
+            if end >= len(buf) or buf[end] not in ' \t\r\n,]}':
+                raise ValueError("Incomplete item")
+        except ValueError:
+            chunk = read_more()
+            if chunk is None:
+                raise ValueError("Truncated JSON response")
+            # Drop the text that has already been decoded, so the buffer
+            # stays about as big as the largest single item.
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        yield item
+        pos = end
+
+
+# Returned by the function passed to RequestCache.get() when Gerrit replied
+# 304 Not Modified.
+NOT_MODIFIED = object()
+
+
+# GETs for these paths return secrets, which must never be written to disk.
+UNCACHED_PATH_PATTERN = re.compile(r'(^|/)password\.http$')
+
+# The cache directory is pruned at most this often, and entries (and their
+# lock files) that haven't been written for CACHE_ENTRY_LIFETIME seconds are
+# deleted. Entries outlive the TTL so that they can be revalidated with their
+# ETag rather than fetched again.
+CACHE_PRUNE_INTERVAL = 3600
+CACHE_ENTRY_LIFETIME = 24 * 3600
+
+
+class RequestCache(object):
+    '''A cache of GET responses that can be shared between processes.
+
+    Each response is stored as a JSON file in 'directory'. While a process
+    fetches a response it holds a lock on that entry, so other processes that
+    want the same path wait and then read the cached result, rather than all
+    sending the same request at once.
+
+    Any write to Gerrit replaces the 'generation' token, which makes every
+    existing entry stale. Entries also become stale after 'ttl' seconds.
+
+    The ETag that Gerrit sent with a response is stored with it. When a stale
+    entry has one, 'fetch' is asked to send If-None-Match, and if Gerrit
+    replies 304 Not Modified the stored body is used again, so unchanged
+    resources cost an empty response rather than a full one.
+
+    Old entries are deleted from time to time by prune().
+
+    '''
+
+    def __init__(self, directory, ttl, namespace=''):
+        self.directory = directory
+        self.ttl = ttl
+        self.namespace = namespace
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created it at the same time.
+                if not os.path.isdir(directory):
+                    raise
+        self.prune()
+
+    def prune(self):
+        '''Delete entries that haven't been written for a long time.'''
+        marker = os.path.join(self.directory, 'pruned')
+        try:
+            if time.time() - os.path.getmtime(marker) < CACHE_PRUNE_INTERVAL:
+                return
+        except OSError:
+            pass
+        self.write_file(marker, '')
+
+        cutoff = time.time() - max(self.ttl, CACHE_ENTRY_LIFETIME)
+        for name in os.listdir(self.directory):
+            if not name.endswith('.lock'):
+                continue
+            lock_path = os.path.join(self.directory, name)
+            entry_path = lock_path[:-len('.lock')]
+            try:
+                if os.path.exists(entry_path):
+                    mtime = os.path.getmtime(entry_path)
+                else:
+                    # The fetch for this entry failed.
+                    mtime = os.path.getmtime(lock_path)
+            except OSError:
+                continue
+            if mtime >= cutoff:
+                continue
+
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # Someone is using the entry right now.
+                    continue
+                try:
+                    for path in (entry_path, lock_path):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def entry_path(self, key):
+        name = hashlib.sha1((self.namespace + '\0' + key).encode('utf-8'))
+        return os.path.join(self.directory, name.hexdigest())
+
+    def generation(self):
+        try:
+            with open(os.path.join(self.directory, 'generation')) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def invalidate(self):
+        self.write_file(os.path.join(self.directory, 'generation'),
+                        '%s-%s' % (os.getpid(), time.time()))
+
+    def write_file(self, path, content):
+        # Write to a temporary file and rename it, so readers never see a
+        # partly written file.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+
+    def read(self, key):
+        try:
+            with open(self.entry_path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write(self, key, generation, body, etag=None):
+        entry = dict(generation=generation, time=time.time(), body=body,
+                     etag=etag)
+        self.write_file(self.entry_path(key), json.dumps(entry))
+
+    def is_fresh(self, entry, generation):
+        return (entry is not None and
+                entry['generation'] == generation and
+                time.time() - entry['time'] < self.ttl)
+
+    def get(self, key, fetch):
+        with open(self.entry_path(key) + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                generation = self.generation()
+                entry = self.read(key)
+                if self.is_fresh(entry, generation):
+                    logging.debug("Using cached response for %s", key)
+                    return entry['body']
+
+                etag = entry.get('etag') if entry is not None else None
+                body, etag = fetch(etag)
+                if body is NOT_MODIFIED:
+                    logging.debug("Cached response for %s is still valid",
+                                  key)
+                    body = entry['body']
+                self.write(key, generation, body, etag)
+                return body
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fetch(self, gerrit, path):
+        '''GET 'path' from the GerritConnection 'gerrit', through the cache.'''
+        if UNCACHED_PATH_PATTERN.search(path):
+            return gerrit.request('GET', path)
+        return self.get(path, lambda etag: conditional_get(gerrit, path, etag))
+
+
+def conditional_get(gerrit, path, etag=None):
+    '''GET 'path', returning (body, ETag) or (NOT_MODIFIED, ETag).'''
+    headers = {'If-None-Match': etag} if etag else None
+    response = gerrit.send('GET', path, headers=headers)
+    if response.status_code == 304:
+        return NOT_MODIFIED, etag
+    return decode_response(response), response.headers.get('ETag')
+
+
+PASSWORD_HASH_ITERATIONS = 10000
+
+
+class PasswordStore(object):
+    '''Salted digests of the HTTP passwords that have been set in Gerrit.
+
+    Gerrit doesn't always let the HTTP password be read back, and when it
+    does that means sending it over the network for every account. Instead,
+    each time a password is set a salted PBKDF2 digest of it is saved in a
+    local JSON file, keyed on the Gerrit URL and account ID. If the password
+    given next time matches the digest, there is nothing to do.
+
+    The file is locked while it is updated, so several processes can share
+    it. It is only ever readable by its owner.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def digest(self, password, salt):
+        return binascii.hexlify(hashlib.pbkdf2_hmac(
+            'sha256', password.encode('utf-8'), salt,
+            PASSWORD_HASH_ITERATIONS)).decode('ascii')
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def matches(self, key, password):
+        entry = self.read().get(key)
+        if entry is None:
+            return False
+        salt = binascii.unhexlify(entry['salt'])
+        return hmac.compare_digest(self.digest(password, salt),
+                                   entry['digest'])
+
+    def remember(self, key, password):
+        salt = os.urandom(16)
+        entry = dict(salt=binascii.hexlify(salt).decode('ascii'),
+                     digest=self.digest(password, salt))
+
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                entries = self.read()
+                entries[key] = entry
+                # mkstemp() creates the file with mode 0600.
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(self.path)))
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f, indent=4, sort_keys=True)
+                os.rename(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class InFlightRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class GerritConnection(object):
+    '''A connection to the Gerrit REST API.
+
+    The URL and authentication handling is done by pygerrit's GerritRestAPI.
+    Requests are sent through a single requests.Session, so that the HTTP
+    connection and the HTTP Digest auth state are reused between requests
+    instead of being set up again each time.
+
+    Identical GET requests made at the same time from different threads are
+    only sent once, and every caller gets a copy of the result. If a
+    RequestCache is given, the same happens between processes too. If a
+    GerritSnapshot is given, GETs for paths it contains don't go to Gerrit
+    at all.
+
+    '''
+
+    def __init__(self, rest_api, cache=None, snapshot=None):
+        self.rest_api = rest_api
+        self.session = requests.Session()
+        self.cache = cache
+        self.snapshot = snapshot
+        self.profiler = None
+
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.generation = 0
+
+    def send(self, method, path, headers=None, **kwargs):
+        all_headers = dict(self.rest_api.kwargs['headers'])
+        all_headers.update(headers or {})
+        if 'data' in kwargs and not any(
+                name.lower() == 'content-type' for name in all_headers):
+            all_headers['Content-Type'] = 'application/json;charset=UTF-8'
+
+        return self.session.request(
+            method, self.rest_api.make_url(path), headers=all_headers,
+            auth=self.rest_api.kwargs['auth'],
+            verify=self.rest_api.kwargs['verify'], **kwargs)
+
+    def request(self, method, path, **kwargs):
+        return decode_response(self.send(method, path, **kwargs))
+
+    def stream(self, path):
+        '''Yield the items of a JSON list response as they are received.
+
+        For responses that are JSON objects, (key, value) pairs are yielded.
+        Streamed responses bypass the in-flight request tracking and the
+        RequestCache, as the point is not to hold the whole response at once.
+
+        '''
+        if self.snapshot is not None and path in self.snapshot:
+            body = self.snapshot.get(path)
+            for item in (body.items() if isinstance(body, dict) else body):
+                yield item
+            return
+
+        with self.phase('fetch'):
+            response = self.send('GET', path.lstrip('/'), stream=True)
+        try:
+            response.raise_for_status()
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            chunks = (decoder.decode(chunk) for chunk in
+                      response.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+            for item in iter_json_items(chunks):
+                yield item
+        finally:
+            response.close()
+
+    def phase(self, name):
+        if self.profiler is None:
+            return NullPhase()
+        return self.profiler.phase(name)
+
+    def fetch(self, path):
+        with self.phase('fetch'):
+            if self.cache is None:
+                return self.request('GET', path)
+            else:
+                return self.cache.fetch(self, path)
+
+    def get(self, path, **kwargs):
+        if len(kwargs) > 0:
+            return self.request('GET', path, **kwargs)
+
+        path = path.lstrip('/')
+        if self.snapshot is not None and path in self.snapshot:
+            return self.snapshot.get(path)
+
+        # A write while a GET is in flight bumps the generation, so that later
+        # readers don't receive the result from before the write.
+        with self.in_flight_lock:
+            key = (self.generation, path)
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = InFlightRequest()
+            else:
+                call.waiters += 1
+
+        if leader:
+            result = None
+            try:
+                result = self.fetch(path)
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self.in_flight_lock:
+                    del self.in_flight[key]
+                    # Callers are free to modify what they get back, so the
+                    # waiters need their own copy.
+                    if call.waiters > 0:
+                        call.result = copy.deepcopy(result)
+                call.done.set()
+            return result
+        else:
+            logging.debug("Waiting for in-flight request for %s", path)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+    def write(self, method, path, **kwargs):
+        with self.in_flight_lock:
+            self.generation += 1
+        try:
+            with self.phase('apply'):
+                return self.request(method, path, **kwargs)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate()
+            if self.snapshot is not None:
+                self.snapshot.record_write(path)
+
+    def put(self, path, **kwargs):
+        return self.write('PUT', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.write('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.write('DELETE', path, **kwargs)
+
+
+# The parameters that gerrit_connection() uses, and the environment variables
+# it falls back to.
+CONNECTION_PARAMS = [
+    ('gerrit_url', 'GERRIT_URL'),
+    ('gerrit_admin_username', 'GERRIT_ADMIN_USERNAME'),
+    ('gerrit_admin_password', 'GERRIT_ADMIN_PASSWORD'),
+    ('gerrit_cache_dir', 'GERRIT_CACHE_DIR'),
+    ('gerrit_cache_ttl', None),
+    ('gerrit_snapshot', 'GERRIT_SNAPSHOT'),
+    ('gerrit_events', 'GERRIT_EVENTS'),
+]
+
+
+def connection_environment():
+    '''Return the connection settings from this process's environment.'''
+    return dict((env_var, os.environ[env_var])
+                for name, env_var in CONNECTION_PARAMS
+                if env_var is not None and os.environ.get(env_var))
+
+
 def gerrit_connection(gerrit_url=None, gerrit_admin_username=None,
-                      gerrit_admin_password=None, **ignored_params):
+                      gerrit_admin_password=None, gerrit_cache_dir=None,
+                      gerrit_cache_ttl=60, gerrit_snapshot=None,
+                      gerrit_events=None, environ=None, **ignored_params):
 
     # Gerrit supports HTTP Digest and HTTP Basic auth. Neither is amazingly
     # secure but HTTP Digest is much better than HTTP Basic. HTTP Basic auth
     # involves sending a password in cleartext. This code only supports Digest.
 
+    # A gerrit_worker passes in the environment of the task it's running.
+    if environ is None:
+        environ = os.environ
+
     if gerrit_url is None:
-        gerrit_url = os.environ.get('GERRIT_URL')
+        gerrit_url = environ.get('GERRIT_URL')
     if gerrit_admin_username is None:
-        gerrit_admin_username = os.environ.get('GERRIT_ADMIN_USERNAME')
+        gerrit_admin_username = environ.get('GERRIT_ADMIN_USERNAME')
     if gerrit_admin_password is None:
-        gerrit_admin_password = os.environ.get('GERRIT_ADMIN_PASSWORD')
+        gerrit_admin_password = environ.get('GERRIT_ADMIN_PASSWORD')
+    if gerrit_cache_dir is None:
+        gerrit_cache_dir = environ.get('GERRIT_CACHE_DIR')
+    if gerrit_snapshot is None:
+        gerrit_snapshot = environ.get('GERRIT_SNAPSHOT')
+    if gerrit_events is None:
+        gerrit_events = environ.get('GERRIT_EVENTS')
 
     if gerrit_url is None or len(gerrit_url) == '':
         raise AnsibleGerritError(
             "You must set the 'gerrit_url' parameter (or set GERRIT_URL in "
             "your environment, if you are operating on 'localhost').")
 
+    import pygerrit.rest
+
     if gerrit_admin_username and gerrit_admin_password:
         auth = requests.auth.HTTPDigestAuth(
             gerrit_admin_username, gerrit_admin_password)
     else:
         auth = None
 
-    gerrit = pygerrit.rest.GerritRestAPI(
-        url=gerrit_url, auth=auth)
+    if gerrit_cache_dir:
+        # Different users may see different things, so they can't share
+        # cache entries.
+        cache = lazy_definition('RequestCache')(
+            gerrit_cache_dir, gerrit_cache_ttl,
+            namespace='%s %s' % (gerrit_url, gerrit_admin_username))
+    else:
+        cache = None
+
+    if gerrit_snapshot:
+        if not os.path.exists(gerrit_snapshot):
+            raise AnsibleGerritError(
+                "Snapshot file %s does not exist" % gerrit_snapshot)
+        snapshot = lazy_definition('GerritSnapshot').load(gerrit_snapshot)
+        if gerrit_events:
+            snapshot.apply_events(gerrit_events)
+    else:
+        snapshot = None
+
+    gerrit = GerritConnection(
+        pygerrit.rest.GerritRestAPI(url=gerrit_url, auth=auth), cache=cache,
+        snapshot=snapshot)
     return gerrit
 
 
+LOG_FORMAT = '%(asctime)s %(process)d %(levelname)s %(message)s'
+
+
+class LazyJSON(object):
+    '''Format 'value' as JSON, but only if the log message is written.
+
+    Use it as a logging argument, instead of calling json.dumps() yourself:
+
+        logging.debug('Group info: %s', LazyJSON(group_info))
+
+    '''
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, indent=4, default=str)
+
+
+def configure_logging(params):
+    '''Set up logging as asked for by the task's parameters.
+
+    Many tasks may be running at once on the same host, so each process hands
+    its log records to a background thread, which appends them to the log
+    file one line at a time. Each line includes the process ID.
+
+    '''
+    log_file = params.get('log_file') or os.environ.get('GERRIT_LOG_FILE')
+    if not log_file:
+        # Nothing will be written, so make every logging call return early.
+        logging.disable(logging.CRITICAL)
+        return
+
+    level_name = (params.get('log_level') or
+                  os.environ.get('GERRIT_LOG_LEVEL') or 'info')
+    level = getattr(logging, level_name.upper(), logging.INFO)
+
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    try:
+        from logging.handlers import QueueHandler, QueueListener
+    except ImportError:
+        # Python 2 doesn't have these, so the log is written synchronously
+        # there.
+        root.addHandler(handler)
+        return
+
+    import queue
+    log_queue = queue.Queue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    # exit_json() and fail_json() end the process with sys.exit(), so this
+    # is where the remaining records get written.
+    atexit.register(listener.stop)
+    root.addHandler(QueueHandler(log_queue))
+
+
+class NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class TaskProfiler(object):
+    '''Measure how long each phase of a task takes.
+
+    Time spent in each phase is added up, and the number of times the phase
+    was entered is counted, so 'fetch' covers every GET request the task made.
+    Phases are always timed, as that costs next to nothing, but they are only
+    reported if the 'profile' or 'profile_dir' parameter was set.
+
+    With 'profile_dir', the whole task after argument parsing is also run
+    under a ProfileRecorder.
+
+    '''
+
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self.enabled = False
+        self.recorder = None
+        self.lock = threading.Lock()
+        self.phase_names = []
+        self.totals = {}
+        self.counts = {}
+        self.add('import', time.time() - MODULE_START_TIME)
+
+    def add(self, name, seconds):
+        with self.lock:
+            if name not in self.totals:
+                self.phase_names.append(name)
+                self.totals[name] = 0.0
+                self.counts[name] = 0
+            self.totals[name] += seconds
+            self.counts[name] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def start(self, params):
+        profile_dir = params.get('profile_dir')
+        self.enabled = bool(params.get('profile') or profile_dir)
+        if profile_dir is not None:
+            self.recorder = lazy_definition('ProfileRecorder')(
+                self.module_name, profile_dir)
+
+    def report(self, output):
+        '''Add the timings to 'output', if profiling was asked for.'''
+        if not self.enabled:
+            return output
+
+        phases = [dict(name=name, seconds=round(self.totals[name], 4),
+                       count=self.counts[name])
+                  for name in self.phase_names]
+        profile = dict(
+            phases=phases,
+            total_seconds=round(time.time() - MODULE_START_TIME, 4))
+        if self.recorder is not None:
+            profile['files'] = self.recorder.save()
+            self.recorder = None
+
+        output = dict(output)
+        output['profile'] = profile
+        return output
+
+
+class ProfileRecorder(object):
+    '''Run the rest of a task under cProfile, and tracemalloc if possible.
+
+    The results are saved to files in 'profile_dir' named after the module,
+    the time and the process ID.
+
+    '''
+
+    def __init__(self, module_name, profile_dir):
+        self.module_name = module_name
+        self.profile_dir = profile_dir
+        try:
+            self.tracemalloc = importlib.import_module('tracemalloc')
+            self.tracemalloc.start()
+        except ImportError:
+            self.tracemalloc = None
+        self.cprofile = importlib.import_module('cProfile').Profile()
+        self.cprofile.enable()
+
+    def save(self):
+        self.cprofile.disable()
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        base = os.path.join(self.profile_dir, '%s-%s-%i' % (
+            self.module_name, time.strftime('%Y%m%dT%H%M%S'), os.getpid()))
+
+        files = [base + '.prof']
+        self.cprofile.dump_stats(files[0])
+
+        if self.tracemalloc is not None:
+            snapshot = self.tracemalloc.take_snapshot()
+            self.tracemalloc.stop()
+            files.append(base + '.tracemalloc.txt')
+            with open(files[-1], 'w') as f:
+                for stat in snapshot.statistics('lineno')[:100]:
+                    f.write('%s\n' % stat)
+        return files
+
+
+def run_in_worker(socket_path, module_name, params):
+    '''Send a task to a tools/gerrit_worker.py process and return its result.
+
+    The worker holds warm connections to Gerrit, so this avoids importing
+    pygerrit and requests and authenticating again in every task. The
+    GERRIT_* variables from this task's environment are sent along with the
+    parameters, as the worker's own environment may be quite different.
+
+    '''
+    import socket
+
+    request = json.dumps(dict(module=module_name, params=params,
+                              environ=connection_environment()))
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(request.encode('utf-8') + b'\n')
+        response_line = sock.makefile('rb').readline()
+    except socket.error as e:
+        raise AnsibleGerritError(
+            "Unable to communicate with gerrit_worker at %s: %s" %
+            (socket_path, e))
+    finally:
+        sock.close()
+
+    if len(response_line) == 0:
+        raise AnsibleGerritError(
+            "gerrit_worker at %s closed the connection without replying" %
+            socket_path)
+
+    response = json.loads(response_line.decode('utf-8'))
+    if 'error' in response:
+        raise AnsibleGerritError(response['error'])
+    return response['output'], response['changed']
+
+
+def run_task(module_name, converge, params, profiler=None):
+    '''Run 'converge' for the task, or forward it to a gerrit_worker.'''
+    profiler = profiler or TaskProfiler(module_name)
+
+    worker_socket = (params.get('gerrit_worker_socket') or
+                     os.environ.get('GERRIT_WORKER_SOCKET'))
+    if worker_socket:
+        with profiler.phase('worker'):
+            return lazy_definition('run_in_worker')(worker_socket,
+                                                    module_name, params)
+
+    with profiler.phase('connect'):
+        gerrit = gerrit_connection(**params)
+    gerrit.profiler = profiler
+
+    # Whatever time isn't spent waiting for Gerrit is spent working out
+    # what to change.
+    start = time.time()
+    try:
+        return converge(gerrit, params)
+    finally:
+        waiting = sum(profiler.totals.get(name, 0) for name in
+                      ('fetch', 'apply'))
+        profiler.add('diff', max(0, time.time() - start - waiting))
+
+
 def value_from_param(field, spec, param_value):
     if 'choices' in spec:
         if param_value not in spec['choices']:
@@ -122,6 +1020,131 @@ def get_list(gerrit, path):
     return values
 
 
+def iter_list(gerrit, path, page_size=None):
+    '''Yield the items of a list endpoint without holding the whole list.
+
+    If 'page_size' is given, the list is requested a page at a time using the
+    'n' and 'S' query parameters, until Gerrit says there are no more items.
+    For endpoints that return a JSON object, such as /groups/ and /projects/,
+    (name, info) pairs are yielded.
+
+    '''
+    if page_size is None:
+        for item in gerrit.stream(path):
+            yield item
+        return
+
+    separator = '&' if '?' in path else '?'
+    start = 0
+    while True:
+        page_path = '%s%sn=%i&S=%i' % (path, separator, page_size, start)
+        count = 0
+        more = False
+        for item in gerrit.stream(page_path):
+            count += 1
+            info = item[1] if isinstance(item, tuple) else item
+            if isinstance(info, dict):
+                more = more or any(info.get(key) for key in info
+                                   if key.startswith('_more_'))
+            yield item
+
+        # Not all endpoints set a _more_* field, in which case a full page
+        # means there might be more.
+        if not more and count < page_size:
+            return
+        start += count
+        if count == 0:
+            return
+
+
+def intern_key(value):
+    '''Intern an identifier, such as a group UUID, that is stored many times.'''
+    try:
+        return intern(str(value))
+    except UnicodeError:
+        # Python 2 can only intern byte strings.
+        return value
+
+
+def diff_group_names(group_infos, desired_names):
+    '''Compare a list of groups from Gerrit against the group names wanted.
+
+    'group_infos' can be a stream from iter_list(). Only the groups that are
+    to be removed are kept, so memory use depends on the size of the change
+    rather than the length of the list. Returns (to_keep, to_remove, to_add),
+    where 'to_remove' maps group names to UUIDs.
+
+    We might receive [""] when the user tries to pass in an empty list, so
+    empty names are ignored.
+
+    '''
+    desired_names = set(name for name in desired_names if len(name) > 0)
+    to_keep = set()
+    to_remove = {}
+    for group_info in group_infos:
+        name = group_info['name']
+        if name in desired_names:
+            to_keep.add(name)
+        else:
+            to_remove[name] = intern_key(group_info['id'])
+    return to_keep, to_remove, desired_names - to_keep
+
+
+class MembershipTable(object):
+    '''Direct group memberships, stored compactly.
+
+    The members of each group are kept as a sorted array of integer account
+    IDs, and included groups as a tuple of interned group UUIDs. With 100k
+    memberships this is a small fraction of the size of the AccountInfo
+    dicts that Gerrit returns for them.
+
+    '''
+
+    def __init__(self):
+        self.members = {}
+        self.includes = {}
+
+    def set_members(self, group_uuid, account_ids):
+        self.members[intern_key(group_uuid)] = array.array(
+            'i', sorted(set(int(account_id) for account_id in account_ids)))
+
+    def set_includes(self, group_uuid, included_uuids):
+        self.includes[intern_key(group_uuid)] = tuple(
+            sorted(set(intern_key(uuid) for uuid in included_uuids)))
+
+    def groups_by_account(self, indirect=False):
+        '''Return a dict mapping account IDs to the UUIDs of their groups.
+
+        With 'indirect', this also lists the groups that an account is in
+        because they include one of its groups, like /accounts/X/groups does.
+
+        '''
+        result = {}
+        for group_uuid, ids in self.members.items():
+            for account_id in ids:
+                result.setdefault(account_id, []).append(group_uuid)
+        if not indirect:
+            return result
+
+        included_by = {}
+        for group_uuid, included_uuids in self.includes.items():
+            for uuid in included_uuids:
+                included_by.setdefault(uuid, []).append(group_uuid)
+        for account_id, group_uuids in result.items():
+            found = set(group_uuids)
+            pending = list(group_uuids)
+            while pending:
+                for uuid in included_by.get(pending.pop(), ()):
+                    if uuid not in found:
+                        found.add(uuid)
+                        pending.append(uuid)
+            result[account_id] = sorted(found)
+        return result
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.members.values())
+
+
 def get_string(gerrit, path):
     try:
         value = gerrit.get(path)
@@ -181,3 +1204,509 @@ def maybe_update_field(gerrit, path, field, gerrit_value, ansible_value,
         value = ansible_value
         changed = True
     return value, changed
+
+
+SNAPSHOT_FORMAT = 1
+
+ALL_ACCOUNTS_QUERY = 'is:active OR is:inactive'
+
+# A special dirty key, meaning every account's list of groups may be stale.
+# Including one group in another changes the groups of all of its members.
+ALL_ACCOUNT_GROUPS = 'all-account-groups'
+
+# Since Gerrit 2.16, accounts and groups are stored in the All-Users
+# repository, so changes to them show up as ref-updated events there.
+ALL_USERS_PROJECT = 'All-Users'
+ACCOUNT_REF_PATTERN = re.compile(r'^refs/users/\d\d/(\d+)$')
+GROUP_REF_PATTERN = re.compile(r'^refs/groups/[0-9a-f]{2}/([0-9a-f]+)$')
+
+
+def keys_changed_by_event(event):
+    '''Return the keys of the snapshot objects that a Gerrit event changed.'''
+    keys = set()
+    if event.get('type') == 'ref-updated':
+        ref_update = event.get('refUpdate', {})
+        project = ref_update.get('project')
+        ref = ref_update.get('refName', '')
+        if ref == 'refs/meta/config':
+            keys.add('project:%s' % project)
+        if project == ALL_USERS_PROJECT:
+            match = ACCOUNT_REF_PATTERN.match(ref)
+            if match:
+                keys.add('account:%s' % match.group(1))
+            match = GROUP_REF_PATTERN.match(ref)
+            if match:
+                keys.add('group:%s' % match.group(1))
+    elif event.get('type') == 'project-created':
+        keys.add('project:%s' % event.get('projectName'))
+    return keys
+
+
+class GerritSnapshot(object):
+    '''A saved copy of Gerrit's state, for offline use and fast re-runs.
+
+    The snapshot holds the bodies of the REST responses that the modules ask
+    for, stored by path, so it can answer their GET requests directly. Every
+    entry also records the key of the object it describes ('account:ID',
+    'group:UUID' or 'project:NAME'), so everything known about an object can
+    be dropped at once when it changes.
+
+    On disk, a snapshot is gzipped JSON with one entry per line. When a
+    module writes to Gerrit, it appends the keys of the objects it changed
+    to a journal next to the snapshot file ('FILE.dirty'). Those objects are
+    left out when the snapshot is next loaded, until `tools/gerrit_snapshot.py
+    refresh` fetches them again.
+
+    Changes made outside of Ansible are picked up from Gerrit's event stream.
+    The snapshot remembers how far it has read through each events file, so
+    only new events are looked at.
+
+    '''
+
+    def __init__(self, path=None, gerrit_url=None):
+        self.path = path
+        self.gerrit_url = gerrit_url
+        self.created = time.time()
+        self.entries = {}
+        self.paths_by_key = {}
+        self.memberships = MembershipTable()
+        self.event_offsets = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        return path.strip('/') in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        '''Return a copy of the response body for 'path', or None.'''
+        entry = self.entries.get(path.strip('/'))
+        if entry is None:
+            return None
+        return copy.deepcopy(entry[1])
+
+    def add(self, key, path, body):
+        path = path.strip('/')
+        with self.lock:
+            self.entries[path] = (key, body)
+            self.paths_by_key.setdefault(key, set()).add(path)
+
+    def keys(self):
+        return list(self.paths_by_key)
+
+    def object_key(self, kind, identifier):
+        '''Return the key of the object at 'kind/identifier'.
+
+        The identifier can be anything the REST API accepts, such as a group
+        name or UUID, as long as the snapshot has an entry for it. It is
+        URL-quoted, as in the path, but the key isn't.
+
+        '''
+        entry = self.entries.get('%s/%s' % (kind, identifier))
+        if entry is not None:
+            return entry[0]
+        return '%s:%s' % (kind[:-1], unquote(identifier))
+
+    def keys_changed_by_write(self, path):
+        parts = path.strip('/').split('/')
+        if len(parts) < 2:
+            return set()
+
+        keys = set([self.object_key(parts[0], parts[1])])
+        if parts[0] == 'groups' and len(parts) >= 4:
+            if parts[2] == 'members':
+                keys.add(self.object_key('accounts', parts[3]))
+            elif parts[2] == 'groups':
+                keys.add(ALL_ACCOUNT_GROUPS)
+        return keys
+
+    def with_dependents(self, keys):
+        '''Return 'keys', plus the keys of objects whose entries embed them.
+
+        A group's /members and /detail entries hold the AccountInfo of each
+        member and the GroupInfo of each included group, and an account's
+        /groups entry holds the GroupInfo of each of its groups. If one of
+        those accounts or groups is renamed, the entries that copy it are
+        stale too.
+
+        '''
+        keys = set(keys)
+        account_ids = set(int(key[len('account:'):]) for key in keys
+                          if key.startswith('account:') and
+                          key[len('account:'):].isdigit())
+        group_uuids = set(key[len('group:'):] for key in keys
+                          if key.startswith('group:'))
+
+        dependents = set()
+        with self.lock:
+            if account_ids:
+                for uuid, ids in self.memberships.members.items():
+                    if not account_ids.isdisjoint(ids):
+                        dependents.add('group:%s' % uuid)
+            for uuid, included_uuids in self.memberships.includes.items():
+                if not group_uuids.isdisjoint(included_uuids):
+                    dependents.add('group:%s' % uuid)
+
+            # Accounts are in a group if they are members of it or of any
+            # group that it includes.
+            pending = list(group_uuids)
+            seen = set(pending)
+            while pending:
+                uuid = pending.pop()
+                for account_id in self.memberships.members.get(uuid, ()):
+                    dependents.add('account:%i' % account_id)
+                for included_uuid in self.memberships.includes.get(uuid, ()):
+                    if included_uuid not in seen:
+                        seen.add(included_uuid)
+                        pending.append(included_uuid)
+        return keys | dependents
+
+    def invalidate(self, keys, dependents=True):
+        '''Drop everything known about the objects named by 'keys'.
+
+        Unless 'dependents' is False, the entries that embed those objects
+        are dropped as well; see with_dependents().
+
+        '''
+        if dependents:
+            keys = self.with_dependents(keys)
+        with self.lock:
+            for key in keys:
+                if key == ALL_ACCOUNT_GROUPS:
+                    for account_key, paths in self.paths_by_key.items():
+                        if account_key.startswith('account:'):
+                            for path in [p for p in paths
+                                         if p.endswith('/groups')]:
+                                paths.discard(path)
+                                self.entries.pop(path, None)
+                else:
+                    for path in self.paths_by_key.pop(key, ()):
+                        self.entries.pop(path, None)
+                    if key.startswith('group:'):
+                        uuid = key[len('group:'):]
+                        self.memberships.members.pop(uuid, None)
+                        self.memberships.includes.pop(uuid, None)
+
+    def record_write(self, path):
+        keys = self.keys_changed_by_write(path)
+        self.invalidate(keys)
+        if self.path is not None:
+            # Each line is written with a single append, so lines from
+            # concurrent tasks don't get mixed up.
+            with open(self.path + '.dirty', 'a') as f:
+                f.write(''.join(key + '\n' for key in sorted(keys)))
+
+    def save(self, path=None):
+        import gzip
+
+        path = path or self.path
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+
+        header = dict(format=SNAPSHOT_FORMAT, gerrit_url=self.gerrit_url,
+                      created=self.created, event_offsets=self.event_offsets)
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write((json.dumps(header) + '\n').encode('utf-8'))
+            for key in sorted(self.paths_by_key):
+                for entry_path in sorted(self.paths_by_key[key]):
+                    line = json.dumps(dict(key=key, path=entry_path,
+                                           body=self.entries[entry_path][1]))
+                    f.write((line + '\n').encode('utf-8'))
+        os.rename(tmp_path, path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path, ignore_journal=False):
+        import gzip
+
+        snapshot = cls(path=path)
+        with gzip.open(path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if header.get('format') != SNAPSHOT_FORMAT:
+                raise AnsibleGerritError(
+                    "Snapshot %s has unsupported format %s" %
+                    (path, header.get('format')))
+            snapshot.gerrit_url = header['gerrit_url']
+            snapshot.created = header['created']
+            snapshot.event_offsets = header.get('event_offsets', {})
+
+            for line in f:
+                entry = json.loads(line.decode('utf-8'))
+                snapshot.add(entry['key'], entry['path'], entry['body'])
+
+        snapshot.load_memberships()
+        if not ignore_journal:
+            snapshot.invalidate(snapshot.dirty_keys())
+        return snapshot
+
+    def dirty_keys(self, journal_path=None):
+        journal_path = journal_path or (self.path + '.dirty')
+        try:
+            with open(journal_path) as f:
+                return set(line.strip() for line in f if line.strip())
+        except IOError:
+            return set()
+
+    def read_events(self, events_path):
+        '''Return the keys changed by events added to 'events_path'.
+
+        Only events after the ones read last time are considered. The new
+        position in the file is kept in the snapshot when it is saved.
+
+        '''
+        events_path = os.path.abspath(events_path)
+        offset = self.event_offsets.get(events_path, 0)
+        if os.path.getsize(events_path) < offset:
+            logging.info("%s has been truncated, reading it from the start",
+                         events_path)
+            offset = 0
+
+        keys = set()
+        with open(events_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Still being written; read it next time.
+                    break
+                offset += len(line)
+                try:
+                    event = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logging.warning("Ignoring invalid event: %r", line)
+                    continue
+                keys.update(keys_changed_by_event(event))
+
+        self.event_offsets[events_path] = offset
+        return keys
+
+    def apply_events(self, events_path):
+        '''Drop whatever the new events in 'events_path' may have changed.
+
+        An event on a group's ref doesn't say whose membership changed, and
+        unlike refresh() this doesn't fetch the group again to find out, so
+        every account's list of groups is dropped as well.
+
+        '''
+        keys = self.read_events(events_path)
+        if any(key.startswith('group:') for key in keys):
+            keys.add(ALL_ACCOUNT_GROUPS)
+        self.invalidate(keys)
+
+    def load_memberships(self):
+        for key in self.paths_by_key:
+            if key.startswith('group:'):
+                uuid = key[len('group:'):]
+                members = self.entries.get('groups/%s/members' % uuid)
+                if members is not None:
+                    self.memberships.set_members(
+                        uuid, [info['_account_id'] for info in members[1]])
+                includes = self.entries.get('groups/%s/groups' % uuid)
+                if includes is not None:
+                    self.memberships.set_includes(
+                        uuid, [info['id'] for info in includes[1]])
+
+    def fetch_account(self, gerrit, account_info, group_infos=None):
+        '''Add an account, fetching whatever 'account_info' doesn't say.
+
+        If 'group_infos' is given, 'account_info' must come from an account
+        query with the DETAILS and ALL_EMAILS options. Then only the SSH keys
+        need to be fetched.
+
+        '''
+        account_info = strip_more_fields(account_info)
+        inactive = account_info.pop('inactive', False)
+        secondary_emails = account_info.pop('secondary_emails', [])
+        account_id = account_info['_account_id']
+        key = 'account:%i' % account_id
+        path = 'accounts/%i' % account_id
+
+        self.add(key, path, account_info)
+        if account_info.get('username'):
+            self.add(key, 'accounts/%s' % quote(account_info['username']),
+                     account_info)
+
+        if group_infos is None:
+            active = get_boolean(gerrit, path + '/active')
+            emails = get_list(gerrit, path + '/emails')
+            group_infos = get_list(gerrit, path + '/groups')
+        else:
+            active = not inactive
+            emails = [dict(email=email) for email in secondary_emails]
+            if account_info.get('email'):
+                emails.insert(0, dict(email=account_info['email'],
+                                      preferred=True))
+        self.add(key, path + '/active', 'ok' if active else '')
+        self.add(key, path + '/emails', emails)
+        self.add(key, path + '/groups', group_infos)
+        self.add(key, path + '/sshkeys', get_list(gerrit, path + '/sshkeys'))
+
+    def fetch_group(self, gerrit, group_info):
+        group_info = strip_more_fields(group_info)
+        includes = group_info.pop('includes', None)
+        members = group_info.pop('members', None)
+        uuid = group_info['id']
+        key = 'group:%s' % uuid
+        path = 'groups/%s' % uuid
+
+        self.add(key, path, group_info)
+        self.add(key, 'groups/%s' % quote(group_info['name']), group_info)
+        self.add(key, path + '/description',
+                 group_info.get('description', ''))
+        if 'owner' in group_info:
+            self.add(key, path + '/owner',
+                     dict(id=group_info.get('owner_id'),
+                          name=group_info['owner']))
+
+        # Listing groups with the INCLUDES and MEMBERS options, or getting
+        # /detail, gives these already.
+        if includes is None:
+            includes = get_list(gerrit, path + '/groups')
+        self.add(key, path + '/groups', includes)
+        if members is None:
+            members = get_list(gerrit, path + '/members')
+        self.add(key, path + '/members', members)
+
+        # The modules read all of the above in one go from /detail.
+        detail = dict(group_info, includes=includes, members=members)
+        self.add(key, path + '/detail', detail)
+        self.add(key, 'groups/%s/detail' % quote(group_info['name']), detail)
+
+        with self.lock:
+            self.memberships.set_includes(uuid,
+                                          [info['id'] for info in includes])
+            self.memberships.set_members(
+                uuid, [info['_account_id'] for info in members])
+
+    def fetch_project(self, gerrit, name, project_info):
+        project_info = strip_more_fields(project_info)
+        key = 'project:%s' % name
+        path = 'projects/%s' % quote(name)
+
+        self.add(key, path, project_info)
+        self.add(key, path + '/config', gerrit.get(path + '/config'))
+
+    def refresh(self, gerrit, keys, workers=8):
+        '''Fetch the objects named by 'keys' from Gerrit again.'''
+        def refresh_key(key):
+            kind, identifier = key.split(':', 1)
+            try:
+                if kind == 'account':
+                    self.fetch_account(
+                        gerrit, gerrit.get('accounts/%s' % quote(identifier)))
+                elif kind == 'group':
+                    self.fetch_group(gerrit, gerrit.get(
+                        'groups/%s/detail' % quote(identifier)))
+                elif kind == 'project':
+                    self.fetch_project(
+                        gerrit, identifier,
+                        gerrit.get('projects/%s' % quote(identifier)))
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code == 404:
+                    logging.info("%s no longer exists", key)
+                else:
+                    raise
+
+        keys = set(keys)
+        all_account_groups = ALL_ACCOUNT_GROUPS in keys
+        keys.discard(ALL_ACCOUNT_GROUPS)
+        keys = self.with_dependents(keys)
+        if all_account_groups:
+            keys.update(key for key in self.keys()
+                        if key.startswith('account:'))
+
+        # Events only tell us that a group changed, not whose membership did,
+        # so compare the group's members before and after.
+        old_memberships = {}
+        for key in keys:
+            if key.startswith('group:'):
+                uuid = key[len('group:'):]
+                old_memberships[uuid] = (
+                    self.memberships.members.get(uuid, ()),
+                    self.memberships.includes.get(uuid, ()))
+
+        self.invalidate(keys, dependents=False)
+        run_in_threads(refresh_key, sorted(keys), workers)
+
+        account_keys = set()
+        for uuid, (old_members, old_includes) in old_memberships.items():
+            new_members = self.memberships.members.get(uuid, ())
+            for account_id in set(old_members).symmetric_difference(
+                    new_members):
+                account_keys.add('account:%i' % account_id)
+            if old_includes != self.memberships.includes.get(uuid, ()):
+                account_keys.update(key for key in self.keys()
+                                    if key.startswith('account:'))
+
+        account_keys.difference_update(keys)
+        if account_keys:
+            # Only these accounts' lists of groups changed, so the groups
+            # that list them as members are still up to date.
+            self.invalidate(account_keys, dependents=False)
+            run_in_threads(refresh_key, sorted(account_keys), workers)
+
+    @classmethod
+    def fetch(cls, gerrit, account_query=ALL_ACCOUNTS_QUERY, page_size=500,
+              workers=8):
+        '''Fetch every account, group and project from Gerrit.
+
+        Inactive accounts are included by default. Otherwise they would
+        look as if they don't exist, and anything that compares an inventory
+        against the snapshot would try to create them again.
+
+        The lists are requested with options that include each group's
+        members and each account's emails and status, so the only
+        per-object requests are for SSH keys and project configs. Groups are
+        fetched first, so that each account's groups can be worked out from
+        their members.
+
+        '''
+        snapshot = cls(gerrit_url=gerrit.rest_api.url)
+
+        groups = iter_list(gerrit, 'groups/?o=INCLUDES&o=MEMBERS',
+                           page_size=page_size)
+        run_in_threads(lambda item: snapshot.fetch_group(gerrit, item[1]),
+                       groups, workers)
+
+        group_infos = dict(
+            (uuid, snapshot.entries['groups/%s' % uuid][1])
+            for uuid in snapshot.memberships.members)
+        groups_by_account = snapshot.memberships.groups_by_account(
+            indirect=True)
+
+        def fetch_account(info):
+            snapshot.fetch_account(gerrit, info, [
+                group_infos[uuid] for uuid in
+                groups_by_account.get(info['_account_id'], [])])
+
+        accounts = iter_list(
+            gerrit, 'accounts/?q=%s&o=DETAILS&o=ALL_EMAILS' %
+            quote(account_query), page_size=page_size)
+        run_in_threads(fetch_account, accounts, workers)
+
+        projects = iter_list(gerrit, 'projects/?d', page_size=page_size)
+        run_in_threads(
+            lambda item: snapshot.fetch_project(gerrit, item[0], item[1]),
+            projects, workers)
+
+        return snapshot
+
+
+def strip_more_fields(info):
+    '''Remove the _more_* paging fields Gerrit adds to the last list item.'''
+    return dict((key, value) for key, value in info.items()
+                if not key.startswith('_more_'))
+
+
+def run_in_threads(function, items, workers):
+    '''Call 'function' for each of 'items', using a pool of threads.'''
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(function, items, chunksize=16):
+            pass
+    finally:
+        pool.close()
+        pool.join()
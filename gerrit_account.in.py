@@ -42,6 +42,13 @@ EXAMPLES = '''
     gerrit_url: http://gerrit.example.com:8080/
     gerrit_admin_username: dicky
     gerrit_admin_password: b0sst0nes
+
+- gerrit_account:
+    username: sam
+    emails:
+        - sam@example.com
+        - sam@example.org
+    preferred_email: sam@example.com
 '''
 
 
@@ -61,6 +68,14 @@ ACCOUNT_ARGUMENTS = dict(
     # authorize the email account.
     email           = dict(type='str'),
 
+    # Sets the complete list of email addresses for the account, as an
+    # alternative to 'email'. Addresses that are already present are left
+    # alone, so unlike 'email' this never deletes and recreates an address.
+    # 'preferred_email' can be used on its own too, in which case the
+    # account's other addresses are kept.
+    emails          = dict(type='list'),
+    preferred_email = dict(type='str'),
+
     # This will remove any SSH keys that aren't what the user specified. As
     # with emails, this is probably annoying in some situations (sorry if it
     # annoyed you), but Ansible modules should *ensure* the system is in the
@@ -69,6 +84,13 @@ ACCOUNT_ARGUMENTS = dict(
     ssh_key         = dict(type='str'),
 
     http_password   = dict(type='str'),
+
+    # Path of a file where a salted digest of each HTTP password is kept once
+    # it has been set (GERRIT_PASSWORD_STORE in the environment also works).
+    # With this, an unchanged password isn't read back from Gerrit or set
+    # again. Without it, the password is read from Gerrit and compared.
+    http_password_store = dict(type='str'),
+
     groups          = dict(type='list'),
 
     active          = dict(type='bool', choices=BOOLEANS)
@@ -117,47 +139,41 @@ def create_group_membership(gerrit, account_id, group_id):
 
 def ensure_only_member_of_these_groups(gerrit, account_id, ansible_groups):
     path = 'accounts/%s' % account_id
-    group_info_list = get_list(gerrit, path + '/groups')
-
-    changed = False
-    gerrit_groups = []
-    for group_info in group_info_list:
-        if group_info['name'] in ansible_groups:
-            logging.info("Preserving %s membership of group %s", path,
-                         group_info)
-            gerrit_groups.append(group_info['name'])
-        else:
-            logging.info("Removing %s from group %s", path, group_info)
-            membership_path = 'groups/%s/members/%s' % (
-                quote(group_info['id']), account_id)
-            try:
-                gerrit.delete(membership_path)
-                changed = True
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 404:
-                    # This is a kludge, it'd be better to work out in advance
-                    # which groups the user is a member of only via membership
-                    # in a different. That's not trivial though with the
-                    # current API Gerrit provides.
-                    logging.info(
-                        "Ignored %s; assuming membership of this group is due "
-                        "to membership of a group that includes it.", e)
-                else:
-                    raise
 
     # If the user gave group IDs instead of group names, this will
     # needlessly recreate the membership. The only actual issue will be that
     # Ansible reports 'changed' when nothing really did change, I think.
-    #
-    # We might receive [""] when the user tries to pass in an empty list, so
-    # handle that.
-    for new_group in set(ansible_groups).difference(gerrit_groups):
-        if len(new_group) > 0:
-            create_group_membership(gerrit, account_id, new_group)
-            gerrit_groups.append(new_group)
+    to_keep, to_remove, to_add = diff_group_names(
+        iter_list(gerrit, path + '/groups'), ansible_groups)
+
+    changed = False
+    for name in sorted(to_keep):
+        logging.info("Preserving %s membership of group %s", path, name)
+
+    for name, group_uuid in sorted(to_remove.items()):
+        logging.info("Removing %s from group %s (%s)", path, name, group_uuid)
+        membership_path = 'groups/%s/members/%s' % (
+            quote(group_uuid), account_id)
+        try:
+            gerrit.delete(membership_path)
             changed = True
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                # This is a kludge, it'd be better to work out in advance
+                # which groups the user is a member of only via membership
+                # in a different. That's not trivial though with the
+                # current API Gerrit provides.
+                logging.info(
+                    "Ignored %s; assuming membership of this group is due "
+                    "to membership of a group that includes it.", e)
+            else:
+                raise
+
+    for name in sorted(to_add):
+        create_group_membership(gerrit, account_id, name)
+        changed = True
 
-    return gerrit_groups, changed
+    return sorted(to_keep | to_add), changed
 
 
 def ensure_only_one_account_email(gerrit, account_id, email):
@@ -186,6 +202,72 @@ def ensure_only_one_account_email(gerrit, account_id, email):
     return email, changed
 
 
+def set_preferred_account_email(gerrit, account_id, email):
+    logging.info('Setting preferred email %s for account %s', email,
+                 account_id)
+
+    path = 'accounts/%s/emails/%s/preferred' % (account_id, quote(email))
+    gerrit.put(path)
+
+
+def ensure_account_emails(gerrit, account_id, ansible_emails,
+                          preferred_email=None):
+    path = 'accounts/%s' % account_id
+    email_info_list = get_list(gerrit, path + '/emails')
+
+    gerrit_emails = [email_info['email'] for email_info in email_info_list]
+    gerrit_preferred_email = None
+    for email_info in email_info_list:
+        if email_info.get('preferred'):
+            gerrit_preferred_email = email_info['email']
+
+    if ansible_emails is None:
+        # Only the preferred address was specified, keep everything else.
+        ansible_emails = list(gerrit_emails)
+
+    if preferred_email:
+        ansible_emails = list(ansible_emails) + [preferred_email]
+
+    # We might receive [""] when the user tries to pass in an empty list. An
+    # address listed twice must only be created once, so drop duplicates
+    # too, keeping the order the addresses were given in.
+    unique_emails = []
+    for email in ansible_emails:
+        if len(email) > 0 and email not in unique_emails:
+            unique_emails.append(email)
+    ansible_emails = unique_emails
+
+    changed = False
+
+    # New addresses are added, and the preferred address set, before anything
+    # is removed, so the account is never left without a preferred email.
+    for new_email in ansible_emails:
+        if new_email not in gerrit_emails:
+            preferred = (new_email == preferred_email)
+            create_account_email(gerrit, account_id, new_email,
+                                 preferred=preferred, no_confirmation=True)
+            if preferred:
+                gerrit_preferred_email = new_email
+            changed = True
+
+    if preferred_email and preferred_email != gerrit_preferred_email:
+        set_preferred_account_email(gerrit, account_id, preferred_email)
+        gerrit_preferred_email = preferred_email
+        changed = True
+
+    for existing_email in gerrit_emails:
+        if existing_email in ansible_emails:
+            logging.info("Keeping %s email %s", path, existing_email)
+        else:
+            logging.info("Removing %s email %s", path, existing_email)
+            gerrit.delete(path + '/emails/%s' % quote(existing_email))
+            if existing_email == gerrit_preferred_email:
+                gerrit_preferred_email = None
+            changed = True
+
+    return ansible_emails, gerrit_preferred_email, changed
+
+
 def ensure_only_one_account_ssh_key(gerrit, account_id, ssh_public_key):
     path = 'accounts/%s' % account_id
     ssh_key_info_list = get_list(gerrit, path + '/sshkeys')
@@ -208,9 +290,41 @@ def ensure_only_one_account_ssh_key(gerrit, account_id, ssh_public_key):
     return ssh_public_key, changed
 
 
+def ensure_http_password(gerrit, account_id, http_password, store_path=None):
+    path = 'accounts/%s' % account_id
+    store_path = store_path or os.environ.get('GERRIT_PASSWORD_STORE')
+    if store_path is None:
+        gerrit_value = get_string(gerrit, path + '/password.http')
+        return maybe_update_field(gerrit, path, 'http_password', gerrit_value,
+                                  http_password,
+                                  gerrit_api_path='password.http')
+
+    store = lazy_definition('PasswordStore')(store_path)
+    key = '%s %s' % (gerrit.rest_api.url, account_id)
+    if store.matches(key, http_password):
+        logging.info("Not updating %s/password.http: same as last set",
+                     path)
+        return http_password, False
+
+    # The password in Gerrit isn't known, so set it even if it might be the
+    # same already.
+    logging.info("Setting %s/password.http", path)
+    set_string(gerrit, path + '/password.http', http_password,
+               field_name='http_password')
+    store.remember(key, http_password)
+    return http_password, True
+
+
 def update_account(gerrit, username=None, **params):
     change = False
 
+    if params.get('email') is not None and (
+            params.get('emails') is not None or
+            params.get('preferred_email') is not None):
+        raise AnsibleGerritError(
+            "The 'email' parameter cannot be combined with 'emails' or "
+            "'preferred_email'.")
+
     try:
         account_info = gerrit.get('/accounts/%s' % quote(username))
     except requests.exceptions.HTTPError as e:
@@ -223,7 +337,7 @@ def update_account(gerrit, username=None, **params):
 
     logging.debug(
         'Existing account info for account %s: %s', username,
-        json.dumps(account_info, indent=4))
+        LazyJSON(account_info))
 
     account_id = account_info['_account_id']
     path = 'accounts/%s' % account_id
@@ -251,6 +365,15 @@ def update_account(gerrit, username=None, **params):
         output['email'] = email
         change |= emails_changed
 
+    if (params.get('emails') is not None or
+            params.get('preferred_email') is not None):
+        emails, preferred_email, emails_changed = ensure_account_emails(
+            gerrit, account_id, params.get('emails'),
+            preferred_email=params.get('preferred_email'))
+        output['emails'] = emails
+        output['preferred_email'] = preferred_email
+        change |= emails_changed
+
     if params.get('groups') is not None:
         groups, groups_changed = ensure_only_member_of_these_groups(
             gerrit, account_id, params['groups'])
@@ -258,11 +381,9 @@ def update_account(gerrit, username=None, **params):
         change |= groups_changed
 
     if params.get('http_password') is not None:
-        http_password = get_string(gerrit, path + '/password.http')
-        http_password, http_password_changed = maybe_update_field(
-            gerrit, path, 'http_password', http_password,
-            params.get('http_password'),
-            gerrit_api_path='password.http')
+        http_password, http_password_changed = ensure_http_password(
+            gerrit, account_id, params['http_password'],
+            params.get('http_password_store'))
         output['http_password'] = http_password
         change |= http_password_changed
 
@@ -275,27 +396,34 @@ def update_account(gerrit, username=None, **params):
     return output, change
 
 
+def converge(gerrit, params):
+    return update_account(gerrit, **params)
+
+
 def main():
-    logging.basicConfig(filename='/tmp/ansible-gerrit-debug.log',
-                        level=logging.DEBUG)
+    profiler = TaskProfiler('gerrit_account')
 
     argument_spec = dict()
     argument_spec.update(ACCOUNT_ARGUMENTS)
     argument_spec.update(GERRIT_COMMON_ARGUMENTS)
+    argument_spec.update(LOGGING_ARGUMENTS)
+    argument_spec.update(PROFILE_ARGUMENTS)
 
-    module = AnsibleModule(argument_spec)
+    with profiler.phase('arguments'):
+        module = AnsibleModule(argument_spec)
+    profiler.start(module.params)
+    configure_logging(module.params)
 
-    logging.debug('Module parameters: %s', json.dumps(module.params, indent=4))
+    logging.debug('Module parameters: %s', LazyJSON(module.params))
 
     try:
-        gerrit = gerrit_connection(**module.params)
-
-        output, changed = update_account(
-            gerrit, **module.params)
-        module.exit_json(changed=changed, **output)
+        output, changed = run_task('gerrit_account', converge, module.params,
+                                   profiler=profiler)
+        module.exit_json(changed=changed, **profiler.report(output))
     except (AnsibleGerritError, requests.exceptions.RequestException) as e:
         logging.error('%r', e)
-        module.fail_json(msg=str(e))
+        module.fail_json(msg=str(e), **profiler.report({}))
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -80,56 +80,75 @@ def create_group_inclusion(gerrit, group_id, include_group_id):
     gerrit.put(path)
 
 
-def ensure_group_includes_only(gerrit, group_id, ansible_included_groups):
+def ensure_group_includes_only(gerrit, group_id, ansible_included_groups,
+                               included_group_infos=None):
     path = 'groups/%s' % group_id
-    included_group_info_list = get_list(gerrit, path + '/groups')
-
-    changed = False
-    gerrit_included_groups = []
-    for included_group_info in included_group_info_list:
-        if included_group_info['name'] in ansible_included_groups:
-            logging.info("Preserving %s membership of %s", included_group_info,
-                         path)
-            gerrit_included_groups.append(included_group_info['name'])
-        else:
-            logging.info("Removing %s from %s", included_group_info, path)
-            membership_path = 'groups/%s/groups/%s' % (
-                quote(group_id), quote(included_group_info['id']))
-            gerrit.delete(membership_path)
-            changed = True
+    if included_group_infos is None:
+        included_group_infos = iter_list(gerrit, path + '/groups')
 
     # If the user gave group IDs instead of group names, this will
     # needlessly recreate the membership. The only actual issue will be that
     # Ansible reports 'changed' when nothing really did change, I think.
-    #
-    # We might receive [""] when the user tries to pass in an empty list, so
-    # handle that.
-    to_add = set(ansible_included_groups).difference(gerrit_included_groups)
-    for include_group in to_add:
-        if len(include_group) > 0:
-            create_group_inclusion(gerrit, group_id, include_group)
-            gerrit_included_groups.append(include_group)
-            changed = True
+    to_keep, to_remove, to_add = diff_group_names(
+        included_group_infos, ansible_included_groups)
 
-    return gerrit_included_groups, changed
+    changed = False
+    for name in sorted(to_keep):
+        logging.info("Preserving %s membership of %s", name, path)
 
+    for name, group_uuid in sorted(to_remove.items()):
+        logging.info("Removing %s (%s) from %s", name, group_uuid, path)
+        membership_path = 'groups/%s/groups/%s' % (
+            quote(group_id), quote(group_uuid))
+        gerrit.delete(membership_path)
+        changed = True
 
-def update_group(gerrit, name=None, **params):
-    change = False
+    for name in sorted(to_add):
+        create_group_inclusion(gerrit, group_id, name)
+        changed = True
+
+    return sorted(to_keep | to_add), changed
 
+
+def get_group_detail(gerrit, name):
+    '''Return the GroupInfo for 'name', or None if there's no such group.
+
+    Where the server supports it, the GroupInfo comes from /groups/X/detail
+    and so includes the 'members' and 'includes' lists too, which saves
+    reading them separately.
+
+    '''
+    path = '/groups/%s' % quote(name)
     try:
-        group_info = gerrit.get('/groups/%s' % quote(name))
+        return gerrit.get(path + '/detail')
     except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 404:
-            logging.info("Group %s not found, creating it.", name)
-            group_info = create_group(gerrit, name)
-            change = True
-        else:
+        if e.response.status_code != 404:
             raise
 
+    # Either the group doesn't exist, or the server is too old to have the
+    # /detail endpoint.
+    try:
+        return gerrit.get(path)
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 404:
+            return None
+        raise
+
+
+def update_group(gerrit, name=None, **params):
+    change = False
+
+    group_info = get_group_detail(gerrit, name)
+    if group_info is None:
+        logging.info("Group %s not found, creating it.", name)
+        group_info = create_group(gerrit, name)
+        # A new group has no members or included groups yet.
+        group_info.update(members=[], includes=[])
+        change = True
+
     logging.debug(
         'Existing group info for group %s: %s', name,
-        json.dumps(group_info, indent=4))
+        LazyJSON(group_info))
 
     # We use the group UUID to identify the group, which is already URL-encoded
     # for us. The 'group_id' field into the group_info data is a different,
@@ -140,10 +159,19 @@ def update_group(gerrit, name=None, **params):
     output = {}
     output['group_id'] = group_id
 
+    # If we got the group's details in one go, there's no need to read each
+    # field separately.
+    have_detail = 'includes' in group_info
+    included_group_infos = group_info.pop('includes', None)
+    group_info.pop('members', None)
+
     # Ansible sets the value of params that the user did not provide to None.
 
     if params.get('description') is not None:
-        description = get_string(gerrit, path + '/description')
+        if have_detail:
+            description = group_info.get('description', '')
+        else:
+            description = get_string(gerrit, path + '/description')
         description, description_changed = maybe_update_field(
             gerrit, path, 'description', description, params['description'])
         group_info['description'] = description
@@ -151,16 +179,20 @@ def update_group(gerrit, name=None, **params):
 
     if params.get('included_groups') is not None:
         included_groups, included_groups_changed = ensure_group_includes_only(
-            gerrit, group_id, params['included_groups'])
+            gerrit, group_id, params['included_groups'],
+            included_group_infos=included_group_infos)
         output['included_groups'] = included_groups
         change |= included_groups_changed
 
     if params.get('owner') is not None:
         # This code path might break if there are two groups with the same
         # name. Gerrit doesn't enforce unique group names.
-        owner_info = gerrit.get(path + '/owner')
+        if have_detail and 'owner' in group_info:
+            owner_name = group_info['owner']
+        else:
+            owner_name = gerrit.get(path + '/owner')['name']
         owner, owner_changed = maybe_update_field(
-            gerrit, path, 'owner', owner_info['name'], params['owner'])
+            gerrit, path, 'owner', owner_name, params['owner'])
         group_info['owner'] = owner
         change |= owner_changed
 
@@ -169,27 +201,34 @@ def update_group(gerrit, name=None, **params):
     return output, change
 
 
+def converge(gerrit, params):
+    return update_group(gerrit, **params)
+
+
 def main():
-    logging.basicConfig(filename='/tmp/ansible-gerrit-debug.log',
-                        level=logging.DEBUG)
+    profiler = TaskProfiler('gerrit_group')
 
     argument_spec = dict()
     argument_spec.update(GROUP_ARGUMENTS)
     argument_spec.update(GERRIT_COMMON_ARGUMENTS)
+    argument_spec.update(LOGGING_ARGUMENTS)
+    argument_spec.update(PROFILE_ARGUMENTS)
 
-    module = AnsibleModule(argument_spec)
+    with profiler.phase('arguments'):
+        module = AnsibleModule(argument_spec)
+    profiler.start(module.params)
+    configure_logging(module.params)
 
-    logging.debug('Module parameters: %s', json.dumps(module.params, indent=4))
+    logging.debug('Module parameters: %s', LazyJSON(module.params))
 
     try:
-        gerrit = gerrit_connection(**module.params)
-
-        output, changed = update_group(
-            gerrit, **module.params)
-        module.exit_json(changed=changed, **output)
+        output, changed = run_task('gerrit_group', converge, module.params,
+                                   profiler=profiler)
+        module.exit_json(changed=changed, **profiler.report(output))
     except (AnsibleGerritError, requests.exceptions.RequestException) as e:
         logging.error('%r', e)
-        module.fail_json(msg=str(e))
+        module.fail_json(msg=str(e), **profiler.report({}))
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -104,7 +104,7 @@ def update_project(gerrit, name=None, **params):
 
     logging.debug(
         'Existing config info for project %s: %s', name,
-        json.dumps(config_info, indent=4))
+        LazyJSON(config_info))
 
     # We provide a value for all fields of the ConfigInput structure. Most of
     # them are optional and will be unchanged if we don't provide a value, but
@@ -149,7 +149,7 @@ def update_project(gerrit, name=None, **params):
     if change:
         logging.debug(
             'Config input for project %s: %s', name,
-            json.dumps(config_input, indent=4))
+            LazyJSON(config_input))
         headers = {'content-type': 'application/json'}
         gerrit.put('/projects/%s/config' % quote(name), data=json.dumps(config_input),
                    headers=headers)
@@ -157,32 +157,39 @@ def update_project(gerrit, name=None, **params):
     return config_info, change
 
 
+def converge(gerrit, params):
+    if params['state'] == 'absent':
+        changed = remove_project(gerrit, **params)
+        return {}, changed
+    else:
+        project_config_info, changed = update_project(gerrit, **params)
+        return dict(project_config_info=project_config_info), changed
+
+
 def main():
-    logging.basicConfig(filename='/tmp/ansible-gerrit-debug.log',
-                        level=logging.DEBUG)
+    profiler = TaskProfiler('gerrit_project')
 
     argument_spec = dict()
     argument_spec.update(PROJECT_ARGUMENTS)
     argument_spec.update(GERRIT_COMMON_ARGUMENTS)
+    argument_spec.update(LOGGING_ARGUMENTS)
+    argument_spec.update(PROFILE_ARGUMENTS)
 
-    module = AnsibleModule(argument_spec)
+    with profiler.phase('arguments'):
+        module = AnsibleModule(argument_spec)
+    profiler.start(module.params)
+    configure_logging(module.params)
 
-    logging.debug('Module parameters: %s', json.dumps(module.params, indent=4))
+    logging.debug('Module parameters: %s', LazyJSON(module.params))
 
     try:
-        gerrit = gerrit_connection(**module.params)
-
-        if module.params['state'] == 'absent':
-            changed = remove_project(gerrit, **module.params)
-            module.exit_json(changed=changed)
-        else:
-            project_config_info, changed = update_project(
-                gerrit, **module.params)
-            module.exit_json(changed=changed,
-                             project_config_info=project_config_info)
+        output, changed = run_task('gerrit_project', converge, module.params,
+                                   profiler=profiler)
+        module.exit_json(changed=changed, **profiler.report(output))
     except (AnsibleGerritError, requests.exceptions.RequestException) as e:
         logging.error('%r', e)
-        module.fail_json(msg=str(e))
+        module.fail_json(msg=str(e), **profiler.report({}))
 
 
-main()
+if __name__ == '__main__':
+    main()
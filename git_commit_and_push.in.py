@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import glob
+import hashlib
+import logging
+import random
+import re
+import shutil
+import tempfile
+import time
+
+from ansible.module_utils.basic import *
+
+
+DOCUMENTATION = '''
+---
+module: git_commit_and_push
+author: Sam Thursfield
+short_description: Create new Git commits and push them to a remote repository
+'''
+
+EXAMPLES = '''
+- git_commit_and_push:
+    repo: ssh://me@gerrit.example.com:29418/All-Projects
+    ref: refs/meta/config
+    files:
+      - ./All-Projects/groups
+      - ./All-Projects/project.config
+    strip_path_components: 1
+    commit_message: |
+      Update Gerrit top-level project configuration.
+
+      This is commit was made from an Ansible playbook.
+
+# Directories are copied recursively, and glob patterns are expanded. With
+# 'delete_unmanaged', any other file under 'prepend_path' in the repo is
+# removed, so the repo ends up with exactly the files in the directory.
+- git_commit_and_push:
+    repo: ssh://me@gerrit.example.com:29418/config
+    files:
+      - ./generated
+      - ./extra/*.yaml
+    strip_path_components: 1
+    prepend_path: config
+    delete_unmanaged: yes
+    commit_message: Update generated configuration.
+'''
+
+
+class GitDirectory(object):
+    def __init__(self, module, path):
+        self.module = module
+        self.path = path
+
+    def run_git(self, args):
+        logging.debug("Running: %s", args)
+
+        rc, stdout, stderr = self.module.run_command(
+            ['git'] + args, cwd=self.path, check_rc=True)
+
+        if len(stdout.strip()) > 0:
+            logging.debug("Stdout: %s", stdout.strip())
+        if len(stderr.strip()) > 0:
+            logging.debug("Stderr: %s", stderr.strip())
+
+    def run_git_with_output(self, args):
+        logging.debug("Running: git %s", args)
+
+        rc, stdout, stderr = self.module.run_command(
+            ['git'] + args, cwd=self.path, check_rc=False)
+
+        logging.debug("Return code: %s", rc)
+        if len(stdout.strip()) > 0:
+            logging.debug("Stdout: %s", stdout.strip())
+        if len(stderr.strip()) > 0:
+            logging.debug("Stderr: %s", stderr.strip())
+
+        return rc, stdout, stderr
+
+    def run_git_unchecked(self, args):
+        return self.run_git_with_output(args)[0]
+
+    def ref_exists_in_origin(self, ref):
+        logging.debug("Checking for ref %s in origin", ref)
+        result = self.run_git_unchecked(
+            ['ls-remote', '--exit-code', 'origin', ref])
+
+        if result == 0:
+            return True
+        elif result == 2:
+            return False
+        else:
+            raise subprocess.CalledProcessError(
+                "git ls-remote command failed.")
+
+    def checkout_ref(self, ref, local_ref=None, create=False):
+        local_ref = local_ref or ref
+
+        # It's a bit weird to use `git fetch` to checkout a ref instead of
+        # using `git checkout`, but this works in cases where the ref is a
+        # special ref that isn't under refs/heads/* or refs/tags/* and so isn't
+        # already fetched by the `git clone` command.
+
+        if self.ref_exists_in_origin(ref):
+            self.run_git(['fetch', '--quiet', 'origin', ref + ':' + local_ref])
+            self.run_git(['checkout', '--quiet', local_ref])
+        elif create:
+            self.run_git(['checkout', '--quiet', '-b', local_ref])
+        else:
+            raise RuntimeError("Remote ref '%s' does not exist" % ref)
+
+    def add_files(self, files_in_repo):
+        # Add the files in batches, so that thousands of files don't make
+        # the command line too long.
+        for i in range(0, len(files_in_repo), GIT_ADD_BATCH_SIZE):
+            self.run_git(['add', '--'] +
+                         files_in_repo[i:i + GIT_ADD_BATCH_SIZE])
+
+    def remove_files(self, files_in_repo):
+        for i in range(0, len(files_in_repo), GIT_ADD_BATCH_SIZE):
+            self.run_git(['rm', '--quiet', '--'] +
+                         files_in_repo[i:i + GIT_ADD_BATCH_SIZE])
+
+    def list_tree(self, ref='HEAD'):
+        '''Return a dict of path -> (mode, blob SHA-1) for the files in 'ref'.
+
+        If 'ref' doesn't exist yet (for example, when the repo is empty), an
+        empty dict is returned.
+
+        '''
+        rc, stdout, stderr = self.module.run_command(
+            ['git', 'ls-tree', '-r', '-z', '--full-tree', ref], cwd=self.path)
+        if rc != 0:
+            logging.debug("Could not list tree of %s: %s", ref, stderr.strip())
+            return {}
+
+        tree = {}
+        for entry in stdout.split('\0'):
+            if len(entry) == 0:
+                continue
+            info, path = entry.split('\t', 1)
+            mode, object_type, sha1 = info.split(' ')
+            tree[path] = (mode, sha1)
+        return tree
+
+    def staging_area_has_changes(self):
+        result = self.run_git_unchecked(['diff-index', '--quiet', 'HEAD'])
+        return result
+
+    def commit(self, author_name='', author_email='', committer_name='',
+               committer_email='', commit_message='', **ignored_kwargs):
+        # self.module.run_command() doesn't let us pass in a separate
+        # environment, so we have to temporarily change os.environ to pass this
+        # in.
+        old_env = os.environ.copy()
+        if author_email:
+            os.environ['GIT_AUTHOR_EMAIL'] = author_email
+        if author_name:
+            os.environ['GIT_AUTHOR_NAME'] = author_name
+        if committer_email:
+            os.environ['GIT_COMMITTER_EMAIL'] = committer_email
+        if committer_name:
+            os.environ['GIT_COMMITTER_NAME'] = committer_name
+        self.run_git(['commit', '--quiet', '--message', commit_message])
+        os.environ = old_env
+
+    def reset_to_origin(self, ref):
+        '''Throw away local changes and move to the latest 'ref' in origin.'''
+        self.run_git(['fetch', '--quiet', 'origin', ref])
+        self.run_git(['reset', '--quiet', '--hard', 'FETCH_HEAD'])
+
+    def push(self, remote_url=None, local_ref=None, remote_ref=None):
+        '''Push 'local_ref' to 'remote_ref'.
+
+        Returns False if the push was rejected because 'remote_ref' has moved
+        on, so that the caller can rebuild the commit on top of the new tip.
+
+        '''
+        refspec = local_ref + ':' + remote_ref
+        rc, stdout, stderr = self.run_git_with_output(
+            ['push', '--quiet', remote_url, refspec])
+        if rc == 0:
+            return True
+        if PUSH_REJECTED_PATTERN.search(stderr):
+            logging.info("Push to %s was rejected: %s", remote_ref,
+                         stderr.strip())
+            return False
+        raise RuntimeError("Pushing to %s failed: %s" % (remote_url, stderr))
+
+
+@contextlib.contextmanager
+def clone_repo(module, url, path=None, profiler=None):
+    '''Clone repo to location for the duration of a 'with' block.'''
+    if path is None:
+        path = tempfile.mkdtemp()
+        logging.debug('Created temporary checkout directory %s' % path)
+    elif os.path.exists(path):
+        raise RuntimeError("Path %s already exists, not overwriting." % path)
+
+    try:
+        with profiler.phase('clone') if profiler else NullPhase():
+            rc, stdout, stderr = module.run_command(
+                ['git', 'clone', '--quiet', '--no-checkout', url, path])
+
+        if rc != 0:
+            raise RuntimeError('Cloning %s failed: %s' % (url, stderr))
+
+        git_directory = GitDirectory(module, path)
+        yield git_directory
+    finally:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+
+GIT_ADD_BATCH_SIZE = 1000
+
+# What `git push` (or Gerrit) says when someone else pushed to the ref first.
+PUSH_REJECTED_PATTERN = re.compile(
+    r'non-fast-forward|non-fast forward|fetch first|\[rejected\]|'
+    r'failed to lock|cannot lock ref')
+
+# Seconds to wait before the first retry of a rejected push. The wait is
+# doubled for each retry after that, plus up to the same again at random so
+# that writers that collided don't collide again.
+PUSH_RETRY_DELAY = 0.5
+
+
+def git_blob_sha1(path):
+    '''Return the SHA-1 that Git would give the contents of 'path'.'''
+    sha1 = hashlib.sha1(b'blob %i\0' % os.path.getsize(path))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def git_file_mode(path):
+    if os.stat(path).st_mode & 0o111:
+        return '100755'
+    else:
+        return '100644'
+
+
+def walk_files(directory):
+    '''Yield the path of every file under 'directory', as it is found.
+
+    Symbolic links to directories are not followed.
+
+    '''
+    scandir = getattr(os, 'scandir', None)
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        if scandir is not None:
+            for entry in scandir(current):
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    yield entry.path
+        else:
+            # Python 2 has no os.scandir().
+            for name in os.listdir(current):
+                path = os.path.join(current, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    pending.append(path)
+                else:
+                    yield path
+
+
+def iter_source_files(patterns):
+    '''Yield each file named by 'patterns'.
+
+    Each pattern can be a file, a directory (which means every file inside
+    it) or a glob pattern matching either of those.
+
+    '''
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            paths = glob.iglob(pattern)
+        else:
+            paths = [pattern]
+
+        found = False
+        for path in paths:
+            if os.path.isdir(path):
+                for file_path in walk_files(path):
+                    found = True
+                    yield file_path
+            elif os.path.exists(path):
+                found = True
+                yield path
+
+        if not found:
+            raise RuntimeError("No files found for '%s'" % pattern)
+
+
+def strip_path_components(path, n_components_to_strip):
+    if n_components_to_strip == 0:
+        return path
+
+    components = os.path.normpath(path).split(os.path.sep)
+
+    logging.debug("Stripping path %s: components %s, %i to strip", path,
+                  components, n_components_to_strip)
+    if n_components_to_strip >= len(components):
+        raise RuntimeError(
+            "Cannot strip more than %i component(s) from path %s" %
+            (len(components) - 1, path))
+
+    return os.path.sep.join(components[n_components_to_strip:])
+
+
+def source_files(params):
+    '''Return (source path, path in repo, (mode, blob SHA-1)) for each file.'''
+    sources = []
+    for source_path in iter_source_files(params['files']):
+        stripped_path = strip_path_components(
+            source_path, params['strip_path_components'])
+        path_in_repo = os.path.normpath(os.path.join(
+            params['prepend_path'], stripped_path))
+        sources.append((source_path, path_in_repo,
+                        (git_file_mode(source_path),
+                         git_blob_sha1(source_path))))
+    return sources
+
+
+def stage_files(repo, sources, params):
+    '''Copy and stage whatever differs from the checked out tree.
+
+    Only the files that differ from what's in the tree already are copied, so
+    the cost of a push depends on how much changed rather than on how many
+    files there are. Returns the number of files added or removed.
+
+    '''
+    tree = repo.list_tree()
+    managed = set()
+    files_in_repo = []
+
+    for source_path, path_in_repo, blob in sources:
+        managed.add(path_in_repo)
+        if tree.get(path_in_repo) == blob:
+            continue
+
+        logging.debug("Updating %s", path_in_repo)
+        target_path = os.path.join(repo.path, path_in_repo)
+        if not os.path.exists(os.path.dirname(target_path)):
+            os.makedirs(os.path.dirname(target_path))
+        shutil.copy(source_path, target_path)
+        files_in_repo.append(path_in_repo)
+
+    if files_in_repo:
+        repo.add_files(files_in_repo)
+
+    files_to_remove = []
+    if params['delete_unmanaged']:
+        prefix = os.path.normpath(params['prepend_path'])
+        for path_in_repo in tree:
+            if prefix == '.' or path_in_repo.startswith(prefix + '/'):
+                if path_in_repo not in managed:
+                    logging.debug("Removing %s", path_in_repo)
+                    files_to_remove.append(path_in_repo)
+        if files_to_remove:
+            repo.remove_files(files_to_remove)
+
+    return len(files_in_repo) + len(files_to_remove)
+
+
+def main():
+    profiler = TaskProfiler('git_commit_and_push')
+
+    argument_spec = dict(
+        author_name     = dict(type='str'),
+        author_email    = dict(type='str'),
+        commit_message  = dict(type='str', required=True),
+        committer_name  = dict(type='str'),
+        committer_email = dict(type='str'),
+        create_ref      = dict(type='bool', choices=BOOLEANS, default=False),
+        delete_unmanaged = dict(type='bool', choices=BOOLEANS, default=False),
+        files           = dict(type='list', required=True),
+        prepend_path    = dict(type='str', default=''),
+        # How many times to try again if the push is rejected because the ref
+        # was updated by someone else in the meantime.
+        push_retries    = dict(type='int', default=5),
+        ref             = dict(type='str', default='master'),
+        repo            = dict(type='str', required=True),
+        strip_path_components = dict(type='int', default=0)
+    )
+    argument_spec.update(LOGGING_ARGUMENTS)
+    argument_spec.update(PROFILE_ARGUMENTS)
+
+    with profiler.phase('arguments'):
+        module = AnsibleModule(argument_spec)
+        if module.params['push_retries'] < 0:
+            module.fail_json(
+                msg="push_retries must be 0 or more, not %i" %
+                module.params['push_retries'])
+    profiler.start(module.params)
+    configure_logging(module.params)
+
+    logging.debug('Module parameters: %s', LazyJSON(module.params))
+
+    try:
+        with clone_repo(module, module.params['repo'],
+                        profiler=profiler) as repo:
+            with profiler.phase('checkout'):
+                repo.checkout_ref(module.params['ref'], local_ref='local',
+                                  create=module.params['create_ref'])
+
+            with profiler.phase('copy'):
+                sources = source_files(module.params)
+
+            # If someone else pushes to the ref between our fetch and our
+            # push, fetch their commit and make ours again on top of it.
+            retries = module.params['push_retries']
+            for attempt in range(retries + 1):
+                with profiler.phase('copy'):
+                    n_changes = stage_files(repo, sources, module.params)
+
+                with profiler.phase('commit'):
+                    changed = n_changes > 0 and \
+                        repo.staging_area_has_changes()
+                    if changed:
+                        logging.info(
+                            "Staging area has changes, creating a new "
+                            "commit.")
+                        repo.commit(**module.params)
+                    else:
+                        logging.info(
+                            "Staging area has no changes after adding "
+                            "files.")
+
+                if not changed:
+                    break
+
+                logging.info(
+                    "Pushing to remote %s ref %s", module.params['repo'],
+                    module.params['ref'])
+                with profiler.phase('push'):
+                    pushed = repo.push(remote_url=module.params['repo'],
+                                       local_ref='local',
+                                       remote_ref=module.params['ref'])
+                if pushed:
+                    break
+                if attempt == retries:
+                    raise RuntimeError(
+                        "Pushing to %s was rejected %i times, giving up." %
+                        (module.params['ref'], retries + 1))
+
+                delay = PUSH_RETRY_DELAY * 2 ** attempt
+                time.sleep(delay + random.uniform(0, delay))
+                with profiler.phase('checkout'):
+                    repo.reset_to_origin(module.params['ref'])
+
+        module.exit_json(changed=bool(changed), **profiler.report({}))
+
+    except (subprocess.CalledProcessError, RuntimeError) as e:
+        logging.error('%r', e)
+        module.fail_json(msg=str(e), **profiler.report({}))
+
+
+if __name__ == '__main__':
+    main()
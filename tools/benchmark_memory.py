@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Compare the memory used by raw Gerrit JSON and by a MembershipTable.
+
+This builds a synthetic set of group memberships twice: once as the lists of
+AccountInfo dicts that /groups/X/members returns, and once as the
+MembershipTable from common.py that snapshots keep them in. It reports the memory each one
+takes (measured with tracemalloc, so Python 3.4 or later is needed) and the
+time taken to diff every group's membership.
+
+Usage:
+
+    tools/benchmark_memory.py --accounts 50000 --groups 5000 \
+        --memberships 100000
+
+'''
+
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+
+from common_loader import load_common
+
+
+def synthetic_infos(n_accounts, n_groups, n_memberships, seed):
+    rng = random.Random(seed)
+    account_infos = [
+        dict(_account_id=1000000 + i, username='user%i' % i,
+             name='User Number %i' % i, email='user%i@example.com' % i)
+        for i in range(n_accounts)]
+    group_infos = [
+        dict(id='%040x' % rng.getrandbits(160), name='Group %i' % i,
+             description='Synthetic group %i' % i,
+             owner_id='%040x' % rng.getrandbits(160))
+        for i in range(n_groups)]
+
+    # Each membership is a copy of the AccountInfo, as it would be if it came
+    # from a separate /groups/X/members response.
+    members = dict((info['id'], []) for info in group_infos)
+    for i in range(n_memberships):
+        group = rng.choice(group_infos)
+        account = rng.choice(account_infos)
+        members[group['id']].append(dict(account))
+    return account_infos, group_infos, members
+
+
+def measure(build):
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    result = build()
+    end = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in end.compare_to(start, 'filename'))
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare raw JSON and MembershipTable memory use")
+    parser.add_argument('--accounts', type=int, default=50000)
+    parser.add_argument('--groups', type=int, default=5000)
+    parser.add_argument('--memberships', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    common = load_common()
+    json_module = __import__('json')
+
+    # Serialise the member lists, so that both representations are built
+    # from the same decoded JSON like they would be from Gerrit's responses.
+    # Only the memberships are measured: the accounts and groups themselves
+    # are the same size whichever way the memberships are kept.
+    account_infos, group_infos, members = synthetic_infos(
+        args.accounts, args.groups, args.memberships, args.seed)
+    payload = json_module.dumps(members)
+    del account_infos, group_infos, members
+
+    def build_raw():
+        return json_module.loads(payload)
+
+    def build_compact():
+        members = json_module.loads(payload)
+        table = common['MembershipTable']()
+        for group_uuid, member_infos in members.items():
+            table.set_members(group_uuid, [info['_account_id']
+                                           for info in member_infos])
+        del members
+        return table
+
+    raw, raw_size = measure(build_raw)
+    table, compact_size = measure(build_compact)
+
+    # Diff each group against a desired membership that drops and adds a
+    # few members, first with the raw dicts and then with the arrays.
+    rng = random.Random(args.seed)
+    desired = {}
+    for group_uuid, ids in table.members.items():
+        ids = list(ids)
+        rng.shuffle(ids)
+        desired[group_uuid] = ids[:len(ids) * 9 // 10] + [
+            rng.randint(1000000, 1000000 + args.accounts)]
+
+    start = time.time()
+    for group_uuid, member_infos in raw.items():
+        current = set(info['_account_id'] for info in member_infos)
+        wanted = set(desired[group_uuid])
+        wanted - current, current - wanted
+    raw_time = time.time() - start
+
+    start = time.time()
+    for group_uuid, ids in table.members.items():
+        current = set(ids)
+        wanted = set(desired[group_uuid])
+        wanted - current, current - wanted
+    compact_time = time.time() - start
+
+    print("%i accounts, %i groups, %i memberships" % (
+        args.accounts, len(raw), len(table)))
+    print("%-10s %12s %12s" % ('', 'memory (MB)', 'diff (ms)'))
+    print("%-10s %12.1f %12.1f" % ('dicts', raw_size / 1e6,
+                                    raw_time * 1000))
+    print("%-10s %12.1f %12.1f" % ('compact', compact_size / 1e6,
+                                    compact_time * 1000))
+    print("The MembershipTable uses %.1f%% of the memory of the member "
+          "dicts." % (
+        100.0 * compact_size / raw_size))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
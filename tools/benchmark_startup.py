@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Measure how long the ansible-gerrit modules take to start up.
+
+Ansible starts a new Python interpreter for every task, so the time taken to
+import a module and parse its arguments is paid thousands of times in a big
+playbook. This script runs each module in the same way Ansible does, with an
+arguments file, many times over and reports the wall-clock time.
+
+The modules are run without a Gerrit URL, so they exit as soon as they have
+parsed their arguments and tried to connect. That is the fixed per-task cost,
+and the part that the lazy imports in common.py are meant to keep small.
+
+Usage:
+
+    make
+    tools/benchmark_startup.py gerrit_account.py gerrit_group.py
+
+To compare against modules built the old way, build them with `cat` into a
+different directory and pass both sets of files.
+
+'''
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Just enough arguments for each module to get past argument parsing.
+MODULE_ARGUMENTS = {
+    'gerrit_account': dict(username='benchmark'),
+    'gerrit_group': dict(name='benchmark'),
+    'gerrit_project': dict(name='benchmark'),
+    'git_commit_and_push': dict(repo='/nonexistent', files=[],
+                                commit_message='benchmark'),
+}
+
+
+def module_name(path):
+    name = os.path.basename(path)
+    if name.endswith('.py'):
+        name = name[:-len('.py')]
+    return name
+
+
+def time_module(python, path, args_path, env, runs):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call([python, path, args_path], env=env,
+                            stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark ansible-gerrit module startup time")
+    parser.add_argument('modules', nargs='+', help="built module files")
+    parser.add_argument('-n', '--runs', type=int, default=20,
+                        help="number of runs per module (default: 20)")
+    parser.add_argument('--python', default=sys.executable,
+                        help="Python interpreter to run the modules with")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    for name in ('GERRIT_URL', 'GERRIT_ADMIN_USERNAME',
+                 'GERRIT_ADMIN_PASSWORD'):
+        env.pop(name, None)
+
+    # Time the bare interpreter too, so the module's own share is visible.
+    fd, empty_path = tempfile.mkstemp(suffix='.py')
+    os.close(fd)
+    baseline = time_module(args.python, empty_path, empty_path, env,
+                           args.runs)
+    os.remove(empty_path)
+
+    print("%-30s %10s %10s %10s" % ('module', 'min (ms)', 'median (ms)',
+                                    'over python'))
+    print("%-30s %10.1f %10.1f %10s" % (
+        '(empty script)', baseline[0] * 1000,
+        baseline[len(baseline) // 2] * 1000, '-'))
+
+    for path in args.modules:
+        fd, args_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'ANSIBLE_MODULE_ARGS':
+                       MODULE_ARGUMENTS.get(module_name(path), {})}, f)
+
+        try:
+            timings = time_module(args.python, path, args_path, env,
+                                  args.runs)
+        finally:
+            os.remove(args_path)
+
+        median = timings[len(timings) // 2]
+        print("%-30s %10.1f %10.1f %10.1f" % (
+            path, timings[0] * 1000, median * 1000,
+            (median - baseline[len(baseline) // 2]) * 1000))
+
+
+if __name__ == '__main__':
+    main()
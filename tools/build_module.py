@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Build a self-contained Ansible module from common.py and a module.in.py file.
+
+This used to be a simple `cat common.py module.in.py`. That meant every module
+carried every helper from common.py, whether it used them or not. Instead, we
+work out which top-level definitions in common.py are used by the module
+(directly, or through other definitions in common.py) and only copy those.
+
+The header of common.py (everything up to and including the docstring) is
+always kept, as is the order and spacing of the definitions that are copied.
+
+Definitions that common.py only refers to through lazy_definition('name'),
+such as the snapshot and cache support, are only needed by some tasks. They
+are copied into a string, LAZY_SOURCE, rather than as code, so that tasks
+that don't use them don't pay to compile them.
+
+Usage:
+
+    build_module.py common.py gerrit_account.in.py -o gerrit_account.py
+
+'''
+
+
+import argparse
+import ast
+import collections
+import sys
+
+
+# The function in common.py that compiles LAZY_SOURCE when it's needed.
+LAZY_LOADER = 'lazy_definition'
+LAZY_SOURCE = 'LAZY_SOURCE'
+
+
+# A top-level statement of common.py. 'text' is its source, including any
+# comments above it, and 'gap' is the blank lines that follow it.
+Chunk = collections.namedtuple('Chunk', ['defined', 'used', 'lazy', 'text',
+                                         'gap'])
+
+
+def names_used(node):
+    '''Return the set of names that are read anywhere inside 'node'.'''
+    used = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            used.add(child.id)
+    return used
+
+
+def names_defined(node):
+    '''Return the set of top-level names bound by the statement 'node'.'''
+    defined = set()
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        defined.add(node.name)
+    elif isinstance(node, (ast.Import, ast.ImportFrom)):
+        for alias in node.names:
+            name = alias.asname or alias.name
+            defined.add(name.split('.')[0])
+    elif isinstance(node, ast.Assign):
+        for target in node.targets:
+            for child in ast.walk(target):
+                if isinstance(child, ast.Name):
+                    defined.add(child.id)
+    else:
+        # Statements such as 'try: import queue ... except ImportError:'
+        # define whatever the statements inside them define.
+        for field in ('body', 'handlers', 'orelse', 'finalbody'):
+            for child in getattr(node, field, None) or []:
+                defined |= names_defined(child)
+    return defined
+
+
+def string_value(node):
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        return node.value if isinstance(node.value, str) else None
+    if isinstance(node, ast.Str):
+        return node.s
+    return None
+
+
+def lazy_names(node):
+    '''Return the names that 'node' asks lazy_definition() for.'''
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call) and \
+                isinstance(child.func, ast.Name) and \
+                child.func.id == LAZY_LOADER and len(child.args) == 1:
+            name = string_value(child.args[0])
+            if name is not None:
+                names.add(name)
+    return names
+
+
+def is_docstring(node):
+    if not isinstance(node, ast.Expr):
+        return False
+    if hasattr(ast, 'Constant') and isinstance(node.value, ast.Constant):
+        return isinstance(node.value.value, str)
+    return isinstance(node.value, ast.Str)
+
+
+def first_line(node, lines):
+    '''Return the index of the first source line belonging to 'node'.
+
+    Decorators and any comment lines directly above the statement are
+    counted as part of it.
+
+    '''
+    start = node.lineno
+    for decorator in getattr(node, 'decorator_list', []):
+        start = min(start, decorator.lineno)
+    start -= 1
+    while start > 0 and lines[start - 1].lstrip().startswith('#'):
+        start -= 1
+    return start
+
+
+def split_common(source):
+    '''Split common.py into a header and a list of top-level Chunks.'''
+    tree = ast.parse(source)
+    lines = source.splitlines(True)
+
+    body = list(tree.body)
+    if body and is_docstring(body[0]):
+        docstring = body.pop(0)
+        # Python 2 gives the last line of a multi-line string as its lineno.
+        header_end = getattr(docstring, 'end_lineno', docstring.lineno)
+    else:
+        header_end = first_line(body[0], lines) if body else len(lines)
+
+    starts = [first_line(node, lines) for node in body] + [len(lines)]
+    chunks = []
+    for i, node in enumerate(body):
+        chunk_lines = lines[max(starts[i], header_end):starts[i + 1]]
+        end = len(chunk_lines)
+        while end > 0 and len(chunk_lines[end - 1].strip()) == 0:
+            end -= 1
+        chunks.append(Chunk(names_defined(node), names_used(node),
+                            lazy_names(node), ''.join(chunk_lines[:end]),
+                            ''.join(chunk_lines[end:])))
+
+    header = ''.join(lines[:header_end])
+    gap = ''.join(lines[header_end:max(header_end, starts[0])])
+    return header + gap, chunks
+
+
+def select_chunks(chunks, wanted):
+    '''Return the indexes of the chunks needed to define 'wanted'.'''
+    providers = {}
+    for i, chunk in enumerate(chunks):
+        for name in chunk.defined:
+            providers.setdefault(name, []).append(i)
+
+    selected = set()
+    pending = list(wanted)
+    while pending:
+        name = pending.pop()
+        for i in providers.get(name, []):
+            if i not in selected:
+                selected.add(i)
+                pending.extend(chunks[i].used)
+    return selected
+
+
+def join_chunks(chunks, indexes):
+    '''Return the source of the given chunks, spaced as in common.py.'''
+    indexes = sorted(indexes)
+    text = []
+    for n, i in enumerate(indexes):
+        text.append(chunks[i].text)
+        # Keep the spacing that was in front of the next chunk, even if the
+        # chunks between are left out, unless there was more after this one.
+        if n + 1 < len(indexes):
+            text.append(max(chunks[i].gap, chunks[indexes[n + 1] - 1].gap,
+                            key=len))
+        else:
+            text.append(chunks[i].gap)
+    return ''.join(text)
+
+
+def string_literal(text):
+    if '"""' not in text and not text.endswith('\\'):
+        return 'r"""' + text + '"""'
+    return repr(text)
+
+
+def build_module(common_source, module_source):
+    header, chunks = split_common(common_source)
+    module_tree = ast.parse(module_source)
+    eager = select_chunks(chunks, names_used(module_tree))
+
+    # Whatever is only reachable through lazy_definition() goes in the lazy
+    # part, including what the lazy definitions themselves ask for.
+    lazy = set()
+    while True:
+        names = lazy_names(module_tree)
+        for i in eager | lazy:
+            names |= chunks[i].lazy
+        needed = select_chunks(chunks, names) - eager
+        if needed == lazy:
+            break
+        lazy = needed
+
+    if lazy:
+        literal = string_literal(join_chunks(chunks, lazy))
+        for i in eager:
+            if LAZY_SOURCE in chunks[i].defined:
+                chunks[i] = chunks[i]._replace(text=chunks[i].text.replace(
+                    '%s = None' % LAZY_SOURCE,
+                    '%s = %s' % (LAZY_SOURCE, literal), 1))
+
+    return header + join_chunks(chunks, eager) + module_source
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a self-contained ansible-gerrit module")
+    parser.add_argument('common', help="path to common.py")
+    parser.add_argument('module', help="path to the module.in.py file")
+    parser.add_argument('-o', '--output', help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    with open(args.common) as f:
+        common_source = f.read()
+    with open(args.module) as f:
+        module_source = f.read()
+
+    output = build_module(common_source, module_source)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main()
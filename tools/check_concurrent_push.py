@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Check that git_commit_and_push survives other writers pushing at once.
+
+This makes a bare repository in a temporary directory, then starts several
+git_commit_and_push tasks at the same moment, each adding its own file to the
+same ref. Most of their first pushes are rejected, because another task got
+there first, so they have to fetch and commit again. At the end, the ref
+must have one commit from every task and all of their files.
+
+    make
+    tools/check_concurrent_push.py --writers 8
+
+The exit status is 1 if any task failed or anything is missing.
+
+'''
+
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+GIT_IDENTITY = ['-c', 'user.name=Check', '-c', 'user.email=check@example.com']
+
+
+def git(args, cwd=None):
+    return subprocess.check_output(['git'] + GIT_IDENTITY + args,
+                                   cwd=cwd).decode('utf-8')
+
+
+def make_remote(tmpdir):
+    remote = os.path.join(tmpdir, 'remote.git')
+    git(['init', '--quiet', '--bare', remote])
+
+    seed = os.path.join(tmpdir, 'seed')
+    git(['init', '--quiet', seed])
+    with open(os.path.join(seed, 'README'), 'w') as f:
+        f.write("Concurrent push check\n")
+    git(['add', 'README'], cwd=seed)
+    git(['commit', '--quiet', '-m', 'Initial commit'], cwd=seed)
+    git(['push', '--quiet', remote, 'HEAD:refs/heads/master'], cwd=seed)
+    return remote
+
+
+def write_arguments(tmpdir, name, params):
+    path = os.path.join(tmpdir, name + '.json')
+    with open(path, 'w') as f:
+        json.dump(dict(ANSIBLE_MODULE_ARGS=params), f)
+    return path
+
+
+def run_module(module, args_path, cwd):
+    return subprocess.Popen([sys.executable, module, args_path], cwd=cwd,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def result(process):
+    stdout, stderr = process.communicate()
+    try:
+        output = json.loads(stdout.decode('utf-8'))
+    except ValueError:
+        output = dict(failed=True, msg=(stdout + stderr).decode('utf-8'))
+    if process.returncode != 0:
+        output['failed'] = True
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check git_commit_and_push with concurrent writers")
+    parser.add_argument(
+        '--module',
+        default=os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'git_commit_and_push.py'),
+        help="the built module (default: git_commit_and_push.py)")
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--push-retries', type=int, default=10)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='check-concurrent-push-')
+    try:
+        remote = make_remote(tmpdir)
+        base = dict(repo=remote, ref='master', strip_path_components=1,
+                    author_name='Check', author_email='check@example.com',
+                    committer_name='Check',
+                    committer_email='check@example.com')
+
+        processes = []
+        for i in range(args.writers):
+            name = 'writer-%i' % i
+            os.mkdir(os.path.join(tmpdir, name))
+            with open(os.path.join(tmpdir, name, name + '.txt'), 'w') as f:
+                f.write("Written by %s\n" % name)
+            args_path = write_arguments(tmpdir, name, dict(
+                base, files=['%s/%s.txt' % (name, name)],
+                commit_message='Add %s' % name,
+                push_retries=args.push_retries))
+            processes.append((name, args_path))
+        processes = [(name, run_module(args.module, args_path, tmpdir))
+                     for name, args_path in processes]
+
+        problems = []
+        for name, process in processes:
+            output = result(process)
+            if output.get('failed'):
+                problems.append("%s failed: %s" % (name, output.get('msg')))
+            elif not output.get('changed'):
+                problems.append("%s reported no change" % name)
+
+        files = git(['--git-dir', remote, 'ls-tree', '--name-only',
+                     'master']).split()
+        for name, process in processes:
+            if name + '.txt' not in files:
+                problems.append("%s.txt is missing from master" % name)
+        commits = int(git(['--git-dir', remote, 'rev-list', '--count',
+                           'master']))
+        if commits != args.writers + 1:
+            problems.append("master has %i commits, expected %i" %
+                            (commits, args.writers + 1))
+
+        # A negative number of retries must be refused, not crash.
+        output = result(run_module(args.module, write_arguments(
+            tmpdir, 'negative', dict(base, files=['writer-0/writer-0.txt'],
+                                     commit_message='Negative retries',
+                                     push_retries=-1)), tmpdir))
+        if not output.get('failed') or 'push_retries' not in \
+                output.get('msg', ''):
+            problems.append("push_retries=-1 was not rejected: %s" %
+                            output.get('msg'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for problem in problems:
+        print(problem)
+    print("%i writers, %i commits on master, %i problems" % (
+        args.writers, commits, len(problems)))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Check that iter_json_items() decodes a response however it is split up.
+
+Streamed responses arrive in chunks that can end anywhere, including in the
+middle of a number or a string. This decodes some fixed payloads split into
+two chunks at every possible offset, and into three chunks at every pair of
+offsets, and checks the result is always the same as json.loads() gives.
+
+    tools/check_json_stream.py
+
+The exit status is 1 if any split gives the wrong result.
+
+'''
+
+
+import collections
+import json
+import sys
+
+from common_loader import load_common
+
+
+PAYLOADS = [
+    ''')]}'
+[{"_account_id": 1000000, "name": "Ann", "score": -3.25e+2},
+ {"_account_id": 1000001, "name": "B\\u00e9la \\"B\\"", "score": 1.5},
+ {"_account_id": -12, "active": true, "more": null, "_more_accounts": false}]
+''',
+    ''')]}'
+{"All-Projects": {"id": "All-Projects", "weight": 1.0}, "a": 1.5e-3,
+ "b": [1, -2, 3.0, 4E5, 0], "c": {}, "d": [], "e": "]}"}
+''',
+    '[123456789, -0.5, 2e10, false]',
+    '{}',
+    '[]',
+]
+
+
+def expected_items(payload):
+    text = payload
+    if text.startswith(")]}'"):
+        text = text[len(")]}'"):]
+    # Keep the keys in order, to compare with the (key, value) pairs.
+    value = json.loads(text, object_pairs_hook=collections.OrderedDict)
+    return list(value.items()) if isinstance(value, dict) else value
+
+
+def decode(iter_json_items, chunks):
+    try:
+        return list(iter_json_items(iter(chunks)))
+    except ValueError as e:
+        return e
+
+
+def main():
+    iter_json_items = load_common()['iter_json_items']
+
+    failures = 0
+    checked = 0
+    for payload in PAYLOADS:
+        expected = expected_items(payload)
+        splits = [[payload]]
+        for i in range(len(payload) + 1):
+            splits.append([payload[:i], payload[i:]])
+            for j in range(i, len(payload) + 1):
+                splits.append([payload[:i], payload[i:j], payload[j:]])
+
+        for chunks in splits:
+            checked += 1
+            result = decode(iter_json_items, chunks)
+            if result != expected:
+                failures += 1
+                if failures <= 10:
+                    print("Split %r gave %r" % (chunks, result))
+
+    print("%i splits checked, %i wrong" % (checked, failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
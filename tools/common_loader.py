@@ -0,0 +1,53 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Load common.py for the scripts in tools/.
+
+common.py isn't a package that can be imported, as it is meant to be
+prepended to each module, so this runs it into a dict instead:
+
+    from common_loader import load_common
+    common = load_common()
+    gerrit = common['gerrit_connection']()
+
+Each file is only loaded once, so every tool in a process shares the same
+classes, and a GerritSnapshot made by one is understood by the others.
+
+'''
+
+
+import os
+import threading
+
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'common.py')
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def load_common(path=DEFAULT_PATH):
+    '''Return the namespace of the common.py at 'path'.'''
+    path = os.path.abspath(path)
+    with _lock:
+        if path not in _loaded:
+            namespace = dict(__name__='common')
+            with open(path) as f:
+                exec(compile(f.read(), path, 'exec'), namespace)
+            _loaded[path] = namespace
+        return _loaded[path]
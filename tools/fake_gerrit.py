@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Local stand-in for the parts of the Gerrit REST API that ansible-gerrit uses.
+
+This is for benchmarking and profiling the modules and tools without a real
+Gerrit instance. It keeps accounts, groups and projects in memory, starting
+from a JSON state file such as the one tools/generate_fixture.py writes:
+
+    tools/generate_fixture.py --scale 1 fixture/
+    tools/fake_gerrit.py --port 8080 --state fixture/state.json &
+    GERRIT_URL=http://localhost:8080/ tools/gerrit_snapshot.py export ...
+
+It answers under both / and /a/, doesn't check credentials, and doesn't try
+to enforce Gerrit's permissions. Responses have Gerrit's )]}' prefix and an
+ETag, and list endpoints support paging with 'n' and 'S', so the modules'
+code paths for those are exercised. The number of requests served is printed
+when the server is interrupted, to compare how many requests a run needed.
+
+'''
+
+
+import argparse
+import hashlib
+import json
+import re
+import signal
+import sys
+import threading
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+    from urllib import unquote
+
+
+GERRIT_MAGIC_JSON_PREFIX = ")]}'\n"
+
+
+class NotFound(Exception):
+    pass
+
+
+class Conflict(Exception):
+    pass
+
+
+class GerritState(object):
+    '''In-memory accounts, groups and projects.'''
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.lock = threading.RLock()
+        self.accounts = {}
+        self.account_ids_by_username = {}
+        self.groups = {}
+        self.group_ids_by_name = {}
+        self.projects = {}
+        self.next_account_id = 1000000
+        for account in data.get('accounts', []):
+            self.add_account(account)
+        for group in data.get('groups', []):
+            self.add_group(group)
+        for project in data.get('projects', []):
+            self.projects[project['name']] = project
+        self.requests = 0
+
+    def add_account(self, account):
+        self.accounts[account['_account_id']] = account
+        if account.get('username'):
+            self.account_ids_by_username[account['username']] = \
+                account['_account_id']
+        self.next_account_id = max(self.next_account_id,
+                                   account['_account_id'] + 1)
+
+    def add_group(self, group):
+        self.groups[group['id']] = group
+        self.group_ids_by_name[group['name']] = group['id']
+
+    def dump(self):
+        return dict(accounts=list(self.accounts.values()),
+                    groups=list(self.groups.values()),
+                    projects=list(self.projects.values()))
+
+    # Accounts
+
+    def find_account(self, key):
+        if key == 'self':
+            raise NotFound(key)
+        if re.match(r'^\d+$', key) and int(key) in self.accounts:
+            return self.accounts[int(key)]
+        if key in self.account_ids_by_username:
+            return self.accounts[self.account_ids_by_username[key]]
+        raise NotFound(key)
+
+    def create_account(self, username):
+        if username in self.account_ids_by_username:
+            raise Conflict(username)
+        account = dict(_account_id=self.next_account_id, username=username,
+                       name=None, active=True, emails=[], sshkeys=[],
+                       http_password=None)
+        self.add_account(account)
+        return account
+
+    def account_info(self, account):
+        info = dict(_account_id=account['_account_id'],
+                    username=account['username'])
+        if account.get('name'):
+            info['name'] = account['name']
+        for email in account.get('emails', []):
+            if email.get('preferred'):
+                info['email'] = email['email']
+        return info
+
+    def account_groups(self, account):
+        '''Groups the account is a member of, directly or indirectly.'''
+        result = set(uuid for uuid, group in self.groups.items()
+                     if account['_account_id'] in group.get('members', []))
+        changed = True
+        while changed:
+            changed = False
+            for uuid, group in self.groups.items():
+                if uuid not in result and \
+                        result.intersection(group.get('includes', [])):
+                    result.add(uuid)
+                    changed = True
+        return [self.group_info(self.groups[uuid]) for uuid in sorted(result)]
+
+    # Groups
+
+    def find_group(self, key):
+        if key in self.groups:
+            return self.groups[key]
+        if key in self.group_ids_by_name:
+            return self.groups[self.group_ids_by_name[key]]
+        raise NotFound(key)
+
+    def create_group(self, name):
+        if name in self.group_ids_by_name:
+            raise Conflict(name)
+        group_id = hashlib.sha1(uuid.uuid4().bytes).hexdigest()
+        group = dict(id=group_id, name=name, description='', owner_id=group_id,
+                     members=[], includes=[])
+        self.add_group(group)
+        return group
+
+    def group_info(self, group, detail=False):
+        info = dict(id=group['id'], name=group['name'],
+                    owner_id=group.get('owner_id', group['id']))
+        owner = self.groups.get(info['owner_id'])
+        if owner:
+            info['owner'] = owner['name']
+        if group.get('description'):
+            info['description'] = group['description']
+        if detail:
+            info['members'] = [
+                self.account_info(self.accounts[account_id])
+                for account_id in group.get('members', [])
+                if account_id in self.accounts]
+            info['includes'] = [
+                self.group_info(self.groups[included])
+                for included in group.get('includes', [])
+                if included in self.groups]
+        return info
+
+    # Projects
+
+    def find_project(self, name):
+        if name in self.projects:
+            return self.projects[name]
+        raise NotFound(name)
+
+    def create_project(self, name):
+        if name in self.projects:
+            raise Conflict(name)
+        project = dict(name=name, description='', state='ACTIVE',
+                       parent='All-Projects')
+        self.projects[name] = project
+        return project
+
+    def project_info(self, project):
+        info = dict(id=project['name'].replace('/', '%2F'),
+                    name=project['name'], parent=project.get('parent'),
+                    state=project.get('state', 'ACTIVE'))
+        if project.get('description'):
+            info['description'] = project['description']
+        return info
+
+    def config_info(self, project):
+        info = {}
+        if project.get('description'):
+            info['description'] = project['description']
+        if project.get('state', 'ACTIVE') != 'ACTIVE':
+            info['state'] = project['state']
+        return info
+
+
+def account_matches(account, query):
+    '''Check 'account' against the few search operators we understand.
+
+    Terms separated by spaces must all match, and alternatives separated by
+    'OR' are tried in turn.
+
+    '''
+    alternatives = query.get('q', [''])[0].split(' OR ')
+    return any(account_matches_terms(account, alternative.split())
+               for alternative in alternatives)
+
+
+def account_matches_terms(account, terms):
+    for term in terms:
+        if term == 'is:active' and not account.get('active', True):
+            return False
+        if term == 'is:inactive' and account.get('active', True):
+            return False
+        if term.startswith('username:') and \
+                account.get('username') != term[len('username:'):]:
+            return False
+    return True
+
+
+def paginate(items, query):
+    limit = int(query.get('n', [0])[0])
+    skip = int(query.get('S', query.get('start', [0]))[0])
+    items = items[skip:]
+    more = False
+    if limit and len(items) > limit:
+        items = items[:limit]
+        more = True
+    return items, more
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if not body:
+            return None
+        try:
+            return json.loads(body.decode('utf-8'))
+        except ValueError:
+            return body.decode('utf-8')
+
+    def send(self, status, payload=None):
+        if status == 204 or payload is None:
+            self.send_response(204 if status == 200 else status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = (GERRIT_MAGIC_JSON_PREFIX + json.dumps(payload)).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.command == 'GET' and \
+                self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        if self.command == 'GET':
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_text(self, status, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self):
+        url = urlparse(self.path)
+        path = url.path
+        if path.startswith('/a/'):
+            path = path[2:]
+        query = parse_qs(url.query)
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        body = self.read_body() if self.command in ('PUT', 'POST') else None
+
+        state = self.server.state
+        with state.lock:
+            state.requests += 1
+            try:
+                status, payload = route(state, self.command, parts, query,
+                                        body)
+            except NotFound as e:
+                return self.send_error_text(404, 'Not found: %s\n' % e)
+            except Conflict as e:
+                return self.send_error_text(409, 'Conflict: %s\n' % e)
+        self.send(status, payload)
+
+    do_GET = do_PUT = do_POST = do_DELETE = dispatch
+
+
+def route(state, method, parts, query, body):
+    kind = parts[0]
+    rest = parts[1:]
+
+    if kind == 'accounts':
+        if rest in ([], ['']):
+            accounts = sorted((a for a in state.accounts.values()
+                               if account_matches(a, query)),
+                              key=lambda a: a['_account_id'])
+            accounts, more = paginate(accounts, query)
+            options = query.get('o', [])
+            result = []
+            for a in accounts:
+                info = state.account_info(a)
+                if 'DETAILS' in options and not a.get('active', True):
+                    info['inactive'] = True
+                if 'ALL_EMAILS' in options:
+                    secondary = [e['email'] for e in a.get('emails', [])
+                                 if not e.get('preferred')]
+                    if secondary:
+                        info['secondary_emails'] = secondary
+                result.append(info)
+            if more and result:
+                result[-1]['_more_accounts'] = True
+            return 200, result
+
+        key = rest[0]
+        if len(rest) == 1:
+            if method == 'PUT':
+                return 201, state.account_info(state.create_account(key))
+            return 200, state.account_info(state.find_account(key))
+
+        account = state.find_account(key)
+        field = rest[1]
+        if field == 'detail':
+            info = state.account_info(account)
+            info['registered_on'] = '2015-01-01 00:00:00.000000000'
+            return 200, info
+        if field == 'name':
+            if method == 'PUT':
+                account['name'] = (body or {}).get('name')
+            return 200, account.get('name') or ''
+        if field == 'active':
+            if method == 'PUT':
+                account['active'] = True
+                return 201, None
+            if method == 'DELETE':
+                account['active'] = False
+                return 204, None
+            return (200, 'ok') if account.get('active', True) else (204, None)
+        if field == 'emails':
+            emails = account.setdefault('emails', [])
+            if len(rest) == 2:
+                return 200, emails
+            email = rest[2]
+            existing = [e for e in emails if e['email'] == email]
+            if len(rest) == 4 and rest[3] == 'preferred':
+                if not existing:
+                    raise NotFound(email)
+                for e in emails:
+                    e['preferred'] = (e['email'] == email)
+                return 200, None
+            if method in ('PUT', 'POST'):
+                if existing:
+                    raise Conflict(email)
+                preferred = bool((body or {}).get('preferred'))
+                if preferred:
+                    for e in emails:
+                        e['preferred'] = False
+                info = dict(email=email)
+                if preferred:
+                    info['preferred'] = True
+                emails.append(info)
+                return 201, info
+            if method == 'DELETE':
+                if not existing:
+                    raise NotFound(email)
+                emails.remove(existing[0])
+                return 204, None
+            if not existing:
+                raise NotFound(email)
+            return 200, existing[0]
+        if field == 'sshkeys':
+            keys = account.setdefault('sshkeys', [])
+            if len(rest) == 2:
+                if method == 'POST':
+                    seq = max([k['seq'] for k in keys] + [0]) + 1
+                    info = dict(seq=seq, ssh_public_key=body, valid=True)
+                    keys.append(info)
+                    return 201, info
+                return 200, keys
+            seq = int(rest[2])
+            existing = [k for k in keys if k['seq'] == seq]
+            if not existing:
+                raise NotFound(seq)
+            if method == 'DELETE':
+                keys.remove(existing[0])
+                return 204, None
+            return 200, existing[0]
+        if field == 'password.http':
+            if method == 'PUT':
+                account['http_password'] = (body or {}).get('http_password')
+                return 200, account['http_password']
+            if method == 'DELETE':
+                account['http_password'] = None
+                return 204, None
+            if not account.get('http_password'):
+                raise NotFound('password.http')
+            return 200, account['http_password']
+        if field == 'groups':
+            return 200, state.account_groups(account)
+        raise NotFound('/'.join(parts))
+
+    if kind == 'groups':
+        if rest in ([], ['']):
+            groups = sorted(state.groups.values(), key=lambda g: g['name'])
+            groups, more = paginate(groups, query)
+            options = query.get('o', [])
+            result = {}
+            for g in groups:
+                info = state.group_info(g, detail=bool(options))
+                if 'MEMBERS' not in options:
+                    info.pop('members', None)
+                if 'INCLUDES' not in options:
+                    info.pop('includes', None)
+                result[g['name']] = info
+            if more and groups:
+                result[groups[-1]['name']]['_more_groups'] = True
+            return 200, result
+
+        key = rest[0]
+        if len(rest) == 1:
+            if method == 'PUT':
+                return 201, state.group_info(state.create_group(key))
+            options = query.get('o', [])
+            group = state.find_group(key)
+            info = state.group_info(group, detail=bool(options))
+            if 'MEMBERS' not in options:
+                info.pop('members', None)
+            if 'INCLUDES' not in options:
+                info.pop('includes', None)
+            return 200, info
+
+        group = state.find_group(key)
+        field = rest[1]
+        if field == 'detail':
+            return 200, state.group_info(group, detail=True)
+        if field == 'description':
+            if method == 'PUT':
+                group['description'] = (body or {}).get('description') or ''
+            return 200, group.get('description', '')
+        if field == 'owner':
+            if method == 'PUT':
+                owner = state.find_group((body or {}).get('owner'))
+                group['owner_id'] = owner['id']
+            return 200, state.group_info(
+                state.groups.get(group['owner_id'], group))
+        if field == 'groups':
+            includes = group.setdefault('includes', [])
+            if len(rest) == 2:
+                return 200, [state.group_info(state.groups[i])
+                             for i in includes if i in state.groups]
+            included = state.find_group(rest[2])
+            if method == 'PUT':
+                if included['id'] not in includes:
+                    includes.append(included['id'])
+                return 201, state.group_info(included)
+            if method == 'DELETE':
+                if included['id'] not in includes:
+                    raise NotFound(rest[2])
+                includes.remove(included['id'])
+                return 204, None
+            return 200, state.group_info(included)
+        if field == 'members':
+            members = group.setdefault('members', [])
+            if len(rest) == 2:
+                return 200, [state.account_info(state.accounts[m])
+                             for m in members if m in state.accounts]
+            account = state.find_account(rest[2])
+            if method == 'PUT':
+                if account['_account_id'] not in members:
+                    members.append(account['_account_id'])
+                return 201, state.account_info(account)
+            if method == 'DELETE':
+                if account['_account_id'] not in members:
+                    raise NotFound(rest[2])
+                members.remove(account['_account_id'])
+                return 204, None
+            return 200, state.account_info(account)
+        raise NotFound('/'.join(parts))
+
+    if kind == 'projects':
+        if rest in ([], ['']):
+            projects = sorted(state.projects.values(),
+                              key=lambda p: p['name'])
+            projects, more = paginate(projects, query)
+            result = dict((p['name'], state.project_info(p))
+                          for p in projects)
+            if more and projects:
+                result[projects[-1]['name']]['_more_projects'] = True
+            return 200, result
+
+        name = rest[0]
+        if len(rest) == 1:
+            if method == 'PUT':
+                return 201, state.project_info(state.create_project(name))
+            return 200, state.project_info(state.find_project(name))
+
+        project = state.find_project(name)
+        if rest[1] == 'config':
+            if method == 'PUT':
+                body = body or {}
+                if 'description' in body:
+                    project['description'] = body['description'] or ''
+                if body.get('state'):
+                    project['state'] = body['state']
+            return 200, state.config_info(project)
+        if rest[1] == 'parent':
+            if method == 'PUT':
+                project['parent'] = (body or {}).get('parent')
+            return 200, project.get('parent')
+        raise NotFound('/'.join(parts))
+
+    raise NotFound('/'.join(parts))
+
+
+class FakeGerritServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state, verbose=False):
+        self.state = state
+        self.verbose = verbose
+        HTTPServer.__init__(self, address, Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a stand-in for the Gerrit REST API")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--state', help="JSON file to load the state from")
+    parser.add_argument('--save', help="JSON file to save the state to when "
+                                       "the server is interrupted")
+    parser.add_argument('--verbose', action='store_true',
+                        help="log every request")
+    args = parser.parse_args()
+
+    data = None
+    if args.state:
+        with open(args.state) as f:
+            data = json.load(f)
+    state = GerritState(data)
+
+    server = FakeGerritServer(('127.0.0.1', args.port), state,
+                              verbose=args.verbose)
+
+    # Background jobs ignore SIGINT, so stop the same way on SIGTERM.
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, interrupt)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stderr.write("Served %i requests.\n" % state.requests)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(state.dump(), f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Generate a synthetic Gerrit instance for benchmarking ansible-gerrit.
+
+The performance work in this repo is only worth anything if it is measured
+against data shaped like a big Gerrit instance. This writes, from a random
+seed and a scale factor:
+
+  - state.json: accounts, groups and projects for tools/fake_gerrit.py.
+    At scale 1 there are 50,000 accounts, 5,000 groups and 10,000 projects.
+    Accounts are members of a few groups each, groups are included in each
+    other in chains up to 20 deep, and projects inherit from each other in a
+    hierarchy.
+  - inventory.json: an inventory (see tools/gerrit_snapshot.py) of the same
+    objects. With --drift, a fraction of the entries differ from the state,
+    are missing, or don't exist in the state yet, so that there is some
+    work for the modules and tools to do.
+  - git/PROJECT.git: bare repositories with a long refs/meta/config history
+    and a big project.config and groups file, for git_commit_and_push. They
+    are written with `git fast-import`, which is much quicker than making
+    each commit with `git commit`.
+
+The same seed and scale always give the same output.
+
+    tools/generate_fixture.py --scale 0.1 --drift 0.01 fixture/
+    tools/fake_gerrit.py --port 8080 --state fixture/state.json &
+    GERRIT_URL=http://localhost:8080/ GERRIT_ADMIN_USERNAME=admin \
+        GERRIT_ADMIN_PASSWORD=secret tools/gerrit_sweep.py \
+        fixture/inventory.json
+
+'''
+
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+
+
+ACCOUNTS = 50000
+GROUPS = 5000
+PROJECTS = 10000
+CONFIG_REPOS = 20
+
+GROUPS_PER_ACCOUNT = 2
+INCLUSION_CHAIN_LENGTH = 20
+INACTIVE_FRACTION = 0.02
+SSH_KEY_FRACTION = 0.3
+ROOT_PROJECT_FRACTION = 0.02
+
+ADMIN_ACCOUNT_ID = 1000000
+FIRST_ACCOUNT_ID = 1000001
+
+# Commits in refs/meta/config all get dates from here on, one hour apart, so
+# that the repositories are the same every time.
+EPOCH = 1420070400
+
+
+def pick(rng, items):
+    # random.choice() gives different results on Python 2 and 3.
+    return items[int(rng.random() * len(items))]
+
+
+def group_uuid(rng):
+    return '%040x' % rng.getrandbits(160)
+
+
+def generate_accounts(rng, n):
+    accounts = [dict(_account_id=ADMIN_ACCOUNT_ID, username='admin',
+                     name='Administrator', active=True,
+                     emails=[dict(email='admin@example.com', preferred=True)],
+                     sshkeys=[], http_password=None)]
+    for i in range(n):
+        username = 'user%05i' % i
+        account = dict(
+            _account_id=FIRST_ACCOUNT_ID + i, username=username,
+            name='User %05i' % i,
+            active=rng.random() >= INACTIVE_FRACTION,
+            emails=[dict(email='%s@example.com' % username, preferred=True)],
+            sshkeys=[], http_password=None)
+        if rng.random() < SSH_KEY_FRACTION:
+            account['sshkeys'].append(dict(
+                seq=1, valid=True,
+                ssh_public_key='ssh-rsa AAAAB3NzaC1yc2E%040x %s@example.com'
+                               % (rng.getrandbits(160), username)))
+        accounts.append(account)
+    return accounts
+
+
+def generate_groups(rng, n, accounts):
+    administrators = dict(
+        id=group_uuid(rng), name='Administrators',
+        description='Gerrit Site Administrators', members=[ADMIN_ACCOUNT_ID],
+        includes=[])
+    administrators['owner_id'] = administrators['id']
+    groups = [administrators,
+              dict(id=group_uuid(rng), name='Non-Interactive Users',
+                   description='Users who perform batch actions on Gerrit',
+                   owner_id=administrators['id'], members=[], includes=[])]
+
+    # Groups are in chains, where each one includes the next. The first group
+    # in each chain owns the rest of it.
+    chain = []
+    for i in range(n):
+        group = dict(id=group_uuid(rng), name='Group %05i' % i,
+                     description='Synthetic group %i' % i, members=[],
+                     includes=[])
+        if i % INCLUSION_CHAIN_LENGTH == 0:
+            group['owner_id'] = administrators['id']
+            chain = [group]
+        else:
+            group['owner_id'] = chain[0]['id']
+            chain[-1]['includes'].append(group['id'])
+            chain.append(group)
+        groups.append(group)
+
+    synthetic = groups[2:]
+    for account in accounts[1:]:
+        for i in range(int(rng.random() * GROUPS_PER_ACCOUNT * 2) + 1):
+            members = pick(rng, synthetic)['members']
+            if account['_account_id'] not in members:
+                members.append(account['_account_id'])
+    return groups
+
+
+def generate_projects(rng, n):
+    projects = [dict(name='All-Projects', parent=None, state='ACTIVE',
+                     description='Access inherited by all other projects.'),
+                dict(name='All-Users', parent='All-Projects', state='ACTIVE',
+                     description='Individual user settings and preferences.')]
+
+    # Each project inherits from a random earlier one, which gives a tree
+    # a few levels deep with some much deeper branches.
+    names = []
+    for i in range(n):
+        name = 'project%05i' % i
+        if i < max(1, n * ROOT_PROJECT_FRACTION) or rng.random() < 0.2:
+            parent = 'All-Projects'
+        else:
+            parent = pick(rng, names)
+        projects.append(dict(name=name, parent=parent, state='ACTIVE',
+                             description='Synthetic project %i' % i))
+        names.append(name)
+    return projects
+
+
+def generate_inventory(rng, accounts, groups, projects, drift):
+    '''Return an inventory that describes the state, give or take 'drift'.'''
+    group_names = dict((group['id'], group['name']) for group in groups)
+    groups_by_account = {}
+    for group in groups:
+        for account_id in group['members']:
+            groups_by_account.setdefault(account_id, []).append(group['name'])
+
+    def keep():
+        # Leave some objects out of the inventory, so that sweeps find them.
+        return rng.random() >= drift / 2
+
+    inventory = dict(accounts=[], groups=[], projects=[])
+    for account in accounts[1:]:
+        if not keep():
+            continue
+        params = dict(username=account['username'], fullname=account['name'],
+                      email=account['emails'][0]['email'],
+                      active=account['active'],
+                      groups=sorted(groups_by_account.get(
+                          account['_account_id'], [])))
+        if rng.random() < drift:
+            params['fullname'] += ' (renamed)'
+        if rng.random() < drift and params['groups']:
+            params['groups'] = params['groups'][1:]
+        inventory['accounts'].append(params)
+
+    for group in groups[2:]:
+        if not keep():
+            continue
+        params = dict(name=group['name'], description=group['description'],
+                      owner=group_names[group['owner_id']],
+                      included_groups=sorted(group_names[uuid] for uuid in
+                                             group['includes']))
+        if rng.random() < drift:
+            params['description'] += ' (changed)'
+        inventory['groups'].append(params)
+
+    for project in projects[2:]:
+        if not keep():
+            continue
+        params = dict(name=project['name'],
+                      description=project['description'])
+        if rng.random() < drift:
+            params['description'] += ' (changed)'
+        inventory['projects'].append(params)
+
+    # And some objects that don't exist yet.
+    for kind, count in (('accounts', len(accounts)), ('groups', len(groups)),
+                        ('projects', len(projects))):
+        for i in range(int(count * drift / 2)):
+            if kind == 'accounts':
+                inventory[kind].append(dict(
+                    username='newuser%05i' % i, fullname='New User %05i' % i,
+                    groups=[pick(rng, groups[2:])['name']]))
+            elif kind == 'groups':
+                inventory[kind].append(dict(
+                    name='New Group %05i' % i, owner='Administrators',
+                    included_groups=[pick(rng, groups[2:])['name']]))
+            else:
+                inventory[kind].append(dict(
+                    name='newproject%05i' % i,
+                    description='New project %i' % i))
+    return inventory
+
+
+def project_config(rng, project, groups, sections, revision):
+    '''Return the project.config and groups files for one revision.'''
+    used = {}
+    lines = ['[project]\n',
+             '\tdescription = %s\n' % project['description'],
+             '[access]\n',
+             '\tinheritFrom = %s\n' % project['parent']]
+    for i in range(sections):
+        read_group = pick(rng, groups)
+        push_group = pick(rng, groups)
+        used[read_group['id']] = read_group['name']
+        used[push_group['id']] = push_group['name']
+        lines.extend([
+            '[access "refs/heads/team%05i/*"]\n' % i,
+            '\tread = group %s\n' % read_group['name'],
+            '\tpush = group %s\n' % push_group['name'],
+            '\tlabel-Code-Review = -2..+2 group %s\n' % push_group['name']])
+    lines.append('# Revision %i\n' % revision)
+
+    groups_file = ['# UUID\tGroup Name\n', '#\n']
+    groups_file.extend('%s\t%s\n' % (uuid, name)
+                       for uuid, name in sorted(used.items()))
+    return ''.join(lines).encode('utf-8'), ''.join(groups_file).encode('utf-8')
+
+
+def write_config_repo(rng, path, project, groups, sections, commits):
+    '''Create a bare repo with 'commits' revisions of refs/meta/config.'''
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+    process = subprocess.Popen(
+        ['git', '--git-dir', path, 'fast-import', '--quiet'],
+        stdin=subprocess.PIPE)
+
+    def data(content):
+        process.stdin.write(b'data %i\n' % len(content))
+        process.stdin.write(content + b'\n')
+
+    for revision in range(commits):
+        config, groups_file = project_config(rng, project, groups, sections,
+                                             revision)
+        process.stdin.write(b'commit refs/meta/config\n')
+        process.stdin.write(
+            b'committer Gerrit Code Review <gerrit@example.com> %i +0000\n' %
+            (EPOCH + revision * 3600))
+        data(b'Update project configuration (revision %i)' % revision)
+        if revision == 0:
+            # Start the ref from nothing rather than from the last commit
+            # fast-import saw.
+            process.stdin.write(b'deleteall\n')
+        process.stdin.write(b'M 100644 inline project.config\n')
+        data(config)
+        process.stdin.write(b'M 100644 inline groups\n')
+        data(groups_file)
+        process.stdin.write(b'\n')
+
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("git fast-import failed for %s" % path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic Gerrit instance for benchmarks")
+    parser.add_argument('output', help="directory to write the fixture to")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help="size relative to 50,000 accounts, 5,000 groups and 10,000 "
+             "projects (default: 1)")
+    parser.add_argument(
+        '--drift', type=float, default=0.0,
+        help="fraction of the inventory that differs from the state "
+             "(default: 0)")
+    parser.add_argument(
+        '--config-repos', type=int,
+        help="number of projects to make refs/meta/config repos for "
+             "(default: %i times the scale)" % CONFIG_REPOS)
+    parser.add_argument(
+        '--config-sections', type=int, default=2000,
+        help="access sections in each project.config (default: 2000)")
+    parser.add_argument(
+        '--config-commits', type=int, default=50,
+        help="commits in each refs/meta/config history (default: 50)")
+    args = parser.parse_args()
+
+    if args.config_repos is None:
+        args.config_repos = int(round(CONFIG_REPOS * args.scale))
+
+    rng = random.Random(args.seed)
+    accounts = generate_accounts(rng, int(ACCOUNTS * args.scale))
+    groups = generate_groups(rng, max(1, int(GROUPS * args.scale)), accounts)
+    projects = generate_projects(rng, max(1, int(PROJECTS * args.scale)))
+    inventory = generate_inventory(rng, accounts, groups, projects,
+                                   args.drift)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    with open(os.path.join(args.output, 'state.json'), 'w') as f:
+        json.dump(dict(accounts=accounts, groups=groups, projects=projects),
+                  f, sort_keys=True)
+    with open(os.path.join(args.output, 'inventory.json'), 'w') as f:
+        json.dump(inventory, f, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+
+    git_dir = os.path.join(args.output, 'git')
+    for project in projects[2:2 + args.config_repos]:
+        path = os.path.join(git_dir, project['name'] + '.git')
+        if os.path.exists(path):
+            sys.stderr.write("%s exists already, not overwriting it\n" % path)
+            continue
+        write_config_repo(rng, path, project, groups,
+                          args.config_sections, args.config_commits)
+
+    n_memberships = sum(len(group['members']) for group in groups)
+    print("%i accounts, %i groups (%i memberships), %i projects, "
+          "%i config repos" % (len(accounts), len(groups), n_memberships,
+                               len(projects), args.config_repos))
+
+
+if __name__ == '__main__':
+    main()
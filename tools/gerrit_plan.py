@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Plan and make all the changes an inventory needs, in dependency order.
+
+The modules each make their changes as soon as they find them, one task at a
+time. If a playbook adds a user to a group before the task that creates the
+group has run, that write fails. This tool works out every change that the
+inventory needs from a snapshot (see gerrit_snapshot.py), orders them so that
+nothing is written before the objects it refers to exist, and then makes
+them in layers, with all the writes in one layer done in parallel.
+
+    tools/gerrit_plan.py show gerrit.snapshot inventory.json
+    tools/gerrit_plan.py apply gerrit.snapshot inventory.json
+
+For example, creating a group comes before including it in another group or
+adding members to it, and adding a new email address to an account comes
+before making it the preferred one and deleting the old one.
+
+`apply` records what it changes in the snapshot's journal (FILE.dirty), so
+run `gerrit_snapshot.py refresh` afterwards. If a write fails, the writes
+that depend on it are skipped, and the exit status is 1. Creating an object
+that turns out to exist already (409 Conflict) doesn't count as a failure.
+
+Passwords can't be compared against a snapshot, so `http_password` in the
+inventory is ignored; use the gerrit_account module for those.
+
+'''
+
+
+import argparse
+import collections
+import json
+import logging
+import sys
+import threading
+
+import gerrit_snapshot
+from common_loader import load_common
+
+
+common = load_common()
+quote = common['quote']
+
+
+JSON_HEADERS = {'content-type': 'application/json'}
+TEXT_HEADERS = {'content-type': 'text/plain'}
+
+
+# A single REST API write. 'provides' and 'requires' are lists of keys like
+# 'group:Testers', naming the things the write creates and the things that
+# must exist before it can be made.
+Mutation = collections.namedtuple(
+    'Mutation', ['method', 'path', 'data', 'headers', 'provides', 'requires',
+                 'description'])
+
+
+def mutation(method, path, data=None, provides=(), requires=(),
+             description=None, headers=None):
+    if data is not None and headers is None:
+        data = json.dumps(data)
+        headers = JSON_HEADERS
+    return Mutation(method, path, data, headers, list(provides),
+                    list(requires), description or '%s %s' % (method, path))
+
+
+def current_preferred_email(snapshot, username):
+    account_info = snapshot.get('accounts/%s' % quote(username))
+    if account_info is None:
+        return None
+    for info in snapshot.get(
+            'accounts/%i/emails' % account_info['_account_id']) or []:
+        if info.get('preferred'):
+            return info['email']
+    return None
+
+
+def creates_object(m):
+    return m.method == 'PUT' and any(
+        key.split(':', 1)[0] in ('account', 'group', 'project')
+        for key in m.provides)
+
+
+def account_mutations(snapshot, username, drifts):
+    path = '/accounts/%s' % quote(username)
+    account_key = 'account:%s' % username
+    fields = dict((d.field, d) for d in drifts)
+
+    if 'exists' in fields:
+        yield mutation('PUT', path, provides=[account_key],
+                       description="create account %s" % username)
+
+    if 'fullname' in fields:
+        yield mutation('PUT', path + '/name',
+                       data=dict(name=fields['fullname'].desired),
+                       requires=[account_key])
+
+    if 'active' in fields:
+        yield mutation('PUT' if fields['active'].desired else 'DELETE',
+                       path + '/active', requires=[account_key])
+
+    # New addresses are added first, then the preferred one is set, and only
+    # then are the old ones removed, so the account always has a preferred
+    # address and Gerrit is never asked to delete it.
+    email_drift = fields.get('email') or fields.get('emails')
+    preferred_drift = fields.get('preferred_email')
+    if email_drift or preferred_drift:
+        if email_drift:
+            current, desired = set(email_drift.current), \
+                set(email_drift.desired)
+        else:
+            current = desired = set()
+        if 'email' in fields:
+            preferred = email_drift.desired[0] if email_drift.desired \
+                else None
+        else:
+            preferred = preferred_drift.desired if preferred_drift else None
+
+        for email in sorted(desired - current):
+            yield mutation(
+                'POST', path + '/emails/%s' % quote(email),
+                data=dict(email=email, preferred=False,
+                          no_confirmation=True),
+                provides=['email:%s:%s' % (username, email)],
+                requires=[account_key])
+
+        delete_requires = [account_key]
+        if preferred is not None and \
+                preferred != current_preferred_email(snapshot, username):
+            preferred_requires = [account_key]
+            if preferred not in current:
+                preferred_requires.append('email:%s:%s' % (username,
+                                                           preferred))
+            yield mutation('PUT', path + '/emails/%s/preferred' %
+                           quote(preferred),
+                           provides=['preferred:%s' % username],
+                           requires=preferred_requires)
+            delete_requires.append('preferred:%s' % username)
+
+        for email in sorted(current - desired):
+            yield mutation('DELETE', path + '/emails/%s' % quote(email),
+                           requires=delete_requires)
+
+    if 'groups' in fields:
+        current = set(fields['groups'].current)
+        desired = set(fields['groups'].desired)
+        for group in sorted(desired - current):
+            yield mutation(
+                'PUT', '/groups/%s/members/%s' % (quote(group),
+                                                  quote(username)),
+                requires=[account_key, 'group:%s' % group],
+                description="add %s to group %s" % (username, group))
+        for group in sorted(current - desired):
+            yield mutation(
+                'DELETE', '/groups/%s/members/%s' % (quote(group),
+                                                     quote(username)),
+                requires=[account_key],
+                description="remove %s from group %s" % (username, group))
+
+    if 'ssh_key' in fields:
+        desired = fields['ssh_key'].desired
+        account_info = snapshot.get('accounts/%s' % quote(username))
+        if account_info is not None:
+            ssh_key_infos = snapshot.get(
+                'accounts/%i/sshkeys' % account_info['_account_id']) or []
+            for info in ssh_key_infos:
+                if info['ssh_public_key'] not in desired:
+                    yield mutation('DELETE',
+                                   path + '/sshkeys/%i' % info['seq'],
+                                   requires=[account_key])
+        for ssh_key in desired:
+            if ssh_key not in fields['ssh_key'].current:
+                yield mutation('POST', path + '/sshkeys', data=ssh_key,
+                               headers=TEXT_HEADERS, requires=[account_key],
+                               description="add SSH key for %s" % username)
+
+
+def group_mutations(name, drifts):
+    path = '/groups/%s' % quote(name)
+    group_key = 'group:%s' % name
+    fields = dict((d.field, d) for d in drifts)
+
+    if 'exists' in fields:
+        yield mutation('PUT', path, provides=[group_key],
+                       description="create group %s" % name)
+
+    if 'description' in fields:
+        yield mutation('PUT', path + '/description',
+                       data=dict(description=fields['description'].desired),
+                       requires=[group_key])
+
+    if 'owner' in fields:
+        owner = fields['owner'].desired
+        yield mutation('PUT', path + '/owner', data=dict(owner=owner),
+                       requires=[group_key, 'group:%s' % owner])
+
+    if 'included_groups' in fields:
+        current = set(fields['included_groups'].current)
+        desired = set(fields['included_groups'].desired)
+        for include in sorted(desired - current):
+            yield mutation(
+                'PUT', path + '/groups/%s' % quote(include),
+                requires=[group_key, 'group:%s' % include],
+                description="include group %s in %s" % (include, name))
+        for include in sorted(current - desired):
+            yield mutation(
+                'DELETE', path + '/groups/%s' % quote(include),
+                requires=[group_key],
+                description="remove group %s from %s" % (include, name))
+
+
+def project_mutations(snapshot, name, drifts):
+    path = '/projects/%s' % quote(name)
+    project_key = 'project:%s' % name
+    fields = dict((d.field, d) for d in drifts)
+
+    if 'exists' in fields:
+        yield mutation('PUT', path, provides=[project_key],
+                       description="create project %s" % name)
+
+    # The description and state are set together, as update_project() in
+    # gerrit_project.in.py does, so that an unchanged description is kept.
+    if 'description' in fields or 'state' in fields:
+        config_info = snapshot.get('projects/%s/config' % quote(name)) or {}
+        config_input = dict(description=config_info.get('description', ''))
+        for field in ('description', 'state'):
+            if field in fields:
+                config_input[field] = fields[field].desired
+        yield mutation('PUT', path + '/config', data=config_input,
+                       requires=[project_key])
+
+
+def plan_mutations(snapshot, inventory):
+    '''Return all the mutations needed to make Gerrit match 'inventory'.'''
+    by_object = collections.OrderedDict()
+    for drift in gerrit_snapshot.inventory_drift(snapshot, inventory):
+        by_object.setdefault((drift.kind, drift.name), []).append(drift)
+
+    mutations = []
+    for (kind, name), drifts in by_object.items():
+        if kind == 'account':
+            mutations.extend(account_mutations(snapshot, name, drifts))
+        elif kind == 'group':
+            mutations.extend(group_mutations(name, drifts))
+        elif kind == 'project':
+            mutations.extend(project_mutations(snapshot, name, drifts))
+    return mutations
+
+
+def order_mutations(mutations):
+    '''Split 'mutations' into layers that can each be run in parallel.
+
+    Each mutation goes in the layer after the last of the mutations that
+    provide what it requires. Requirements that nothing in the plan provides
+    are assumed to exist already.
+
+    '''
+    providers = collections.defaultdict(list)
+    for index, m in enumerate(mutations):
+        for key in m.provides:
+            providers[key].append(index)
+
+    depth = {}
+
+    def find_depth(index, visiting):
+        if index in depth:
+            return depth[index]
+        if index in visiting:
+            raise common['AnsibleGerritError'](
+                "Dependency cycle involving: %s" %
+                mutations[index].description)
+        visiting.add(index)
+        result = 0
+        for key in mutations[index].requires:
+            for provider in providers.get(key, []):
+                if provider != index:
+                    result = max(result, find_depth(provider, visiting) + 1)
+        visiting.discard(index)
+        depth[index] = result
+        return result
+
+    layers = []
+    for index in range(len(mutations)):
+        d = find_depth(index, set())
+        while len(layers) <= d:
+            layers.append([])
+        layers[d].append(mutations[index])
+    return layers
+
+
+def apply_layers(gerrit, layers, workers):
+    '''Make the writes in each layer, in parallel, one layer at a time.
+
+    Returns a list of (mutation, error) pairs for the writes that failed or
+    were skipped.
+
+    '''
+    failures = []
+    unavailable = set()
+    lock = threading.Lock()
+
+    def run(m):
+        try:
+            gerrit.write(m.method, m.path, data=m.data, headers=m.headers)
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            if creates_object(m) and response is not None and \
+                    response.status_code == 409:
+                # Created since the snapshot was taken, or missing from it.
+                # Either way it exists, so what depends on it can go ahead.
+                logging.info("Already exists: %s", m.description)
+                return
+            logging.warning("Failed: %s: %s", m.description, e)
+            with lock:
+                failures.append((m, str(e)))
+                unavailable.update(m.provides)
+        else:
+            logging.info("Done: %s", m.description)
+
+    for number, layer in enumerate(layers):
+        ready = []
+        for m in layer:
+            missing = unavailable.intersection(m.requires)
+            if missing:
+                failures.append((m, "skipped, as %s is not available" %
+                                 ', '.join(sorted(missing))))
+                unavailable.update(m.provides)
+            else:
+                ready.append(m)
+
+        logging.info("Layer %i: %i writes", number, len(ready))
+        common['run_in_threads'](run, ready, workers)
+    return failures
+
+
+def load_plan(args):
+    snapshot = common['GerritSnapshot'].load(args.snapshot)
+    inventory = gerrit_snapshot.load_inventory(args.inventory)
+    return order_mutations(plan_mutations(snapshot, inventory))
+
+
+def cmd_show(args):
+    layers = load_plan(args)
+    if args.json:
+        json.dump([[m._asdict() for m in layer] for layer in layers],
+                  sys.stdout, indent=4)
+        sys.stdout.write('\n')
+    else:
+        for number, layer in enumerate(layers):
+            print("Layer %i:" % number)
+            for m in layer:
+                print("    %s" % m.description)
+
+
+def cmd_apply(args):
+    layers = load_plan(args)
+    gerrit = common['gerrit_connection'](gerrit_url=args.gerrit_url,
+                                         gerrit_snapshot=args.snapshot)
+    failures = apply_layers(gerrit, layers, args.workers)
+
+    total = sum(len(layer) for layer in layers)
+    for m, error in failures:
+        print("%s: %s" % (m.description, error))
+    print("%i of %i writes made in %i layers." % (
+        total - len(failures), total, len(layers)))
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Make the changes an inventory needs in dependency order")
+    parser.add_argument('--gerrit-url', help="URL of the Gerrit instance")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="number of concurrent requests (default: 8)")
+    parser.add_argument('--verbose', action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+
+    show_parser = subparsers.add_parser(
+        'show', help="print the planned writes, layer by layer")
+    show_parser.add_argument('snapshot')
+    show_parser.add_argument('inventory')
+    show_parser.add_argument('--json', action='store_true',
+                             help="output the plan as JSON")
+    show_parser.set_defaults(function=cmd_show)
+
+    apply_parser = subparsers.add_parser(
+        'apply', help="make the planned writes")
+    apply_parser.add_argument('snapshot')
+    apply_parser.add_argument('inventory')
+    apply_parser.set_defaults(function=cmd_apply)
+
+    args = parser.parse_args()
+    if not getattr(args, 'function', None):
+        parser.error("a command is required")
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
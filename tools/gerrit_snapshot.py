@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Save Gerrit's state to a snapshot file, keep it up to date, and compare it
+against what an inventory says it should be.
+
+    tools/gerrit_snapshot.py export gerrit.snapshot
+    tools/gerrit_snapshot.py refresh gerrit.snapshot [--events FILE]
+    tools/gerrit_snapshot.py follow gerrit.snapshot --command CMD
+    tools/gerrit_snapshot.py diff gerrit.snapshot inventory.json
+
+The Gerrit URL and admin credentials are taken from --gerrit-url or the
+GERRIT_URL, GERRIT_ADMIN_USERNAME and GERRIT_ADMIN_PASSWORD environment
+variables, the same as for the modules.
+
+Pass the snapshot to the modules with the 'gerrit_snapshot' parameter (or
+GERRIT_SNAPSHOT in the environment) to have them read from it instead of
+from Gerrit. Any object the modules change is recorded in FILE.dirty, and
+`refresh` fetches just those objects again.
+
+Changes made to Gerrit by other means are found from its event stream.
+`refresh --events FILE` reads events that were saved from `gerrit
+stream-events` (one JSON object per line). `follow` runs a command such as
+
+    ssh -p 29418 admin@gerrit.example.com gerrit stream-events
+
+and keeps the snapshot up to date for as long as it runs, refreshing every
+--interval seconds. With --record FILE it also saves the events it sees, so
+the modules can be given the same file as their 'gerrit_events' parameter.
+
+The inventory is a JSON (or, if PyYAML is installed, YAML) file listing the
+same parameters that the gerrit_account, gerrit_group and gerrit_project
+tasks take:
+
+    {
+        "accounts": [{"username": "jenkins", "groups": ["Testers"]}],
+        "groups": [{"name": "Testers", "owner": "Administrators"}],
+        "projects": [{"name": "Morph", "description": "Build tool"}]
+    }
+
+`diff` doesn't contact Gerrit at all. It prints one line for every way in
+which the snapshot differs from the inventory, and exits with status 1 if
+there are any.
+
+'''
+
+
+import argparse
+import collections
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from common_loader import load_common
+
+
+common = load_common()
+quote = common['quote']
+
+
+Drift = collections.namedtuple(
+    'Drift', ['kind', 'name', 'field', 'current', 'desired'])
+
+
+def load_inventory(path):
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            import yaml
+            inventory = yaml.safe_load(f)
+        else:
+            inventory = json.load(f)
+
+    for kind in ('accounts', 'groups', 'projects'):
+        inventory.setdefault(kind, [])
+    return inventory
+
+
+def non_empty(names):
+    # Like the modules, treat [""] as an empty list.
+    return set(name for name in names if len(name) > 0)
+
+
+def account_drift(snapshot, params, groups_by_account):
+    username = params['username']
+    account_info = snapshot.get('accounts/%s' % quote(username))
+    if account_info is None:
+        # Compare the rest against a new, empty account.
+        yield Drift('account', username, 'exists', False, True)
+        account_info = {}
+        path = None
+    else:
+        path = 'accounts/%i' % account_info['_account_id']
+
+    def entry(suffix, new_value):
+        if path is None:
+            return new_value
+        return snapshot.get(path + suffix)
+
+    fullname = params.get('fullname')
+    if fullname is not None and fullname != account_info.get('name'):
+        yield Drift('account', username, 'fullname',
+                    account_info.get('name'), fullname)
+
+    active = params.get('active')
+    current_active = entry('/active', 'ok')
+    if active is not None and current_active is not None:
+        current = current_active == 'ok'
+        if current != bool(active):
+            yield Drift('account', username, 'active', current, bool(active))
+
+    email_infos = entry('/emails', [])
+    if email_infos is not None:
+        emails = [info['email'] for info in email_infos]
+        preferred = [info['email'] for info in email_infos
+                     if info.get('preferred')]
+
+        if params.get('email') is not None:
+            desired = [params['email']] if params['email'] else []
+            if emails != desired:
+                yield Drift('account', username, 'email', emails, desired)
+
+        if params.get('emails') is not None:
+            desired = non_empty(params['emails'])
+            if params.get('preferred_email'):
+                desired.add(params['preferred_email'])
+            if set(emails) != desired:
+                yield Drift('account', username, 'emails', sorted(emails),
+                            sorted(desired))
+
+        preferred_email = params.get('preferred_email')
+        if preferred_email and preferred != [preferred_email]:
+            yield Drift('account', username, 'preferred_email',
+                        preferred[0] if preferred else None, preferred_email)
+
+    if params.get('groups') is not None:
+        # Gerrit's list of an account's groups includes groups it is only
+        # in through another group, so use the direct memberships instead.
+        group_uuids = groups_by_account.get(account_info.get('_account_id'),
+                                            [])
+        current = set(snapshot.get('groups/%s' % uuid)['name']
+                      for uuid in group_uuids)
+        desired = non_empty(params['groups'])
+        if current != desired:
+            yield Drift('account', username, 'groups', sorted(current),
+                        sorted(desired))
+
+    if params.get('ssh_key') is not None:
+        ssh_key_infos = entry('/sshkeys', [])
+        if ssh_key_infos is not None:
+            current = [info['ssh_public_key'] for info in ssh_key_infos]
+            desired = [params['ssh_key']] if params['ssh_key'] else []
+            if current != desired:
+                yield Drift('account', username, 'ssh_key', current, desired)
+
+
+def group_drift(snapshot, params):
+    name = params['name']
+    group_info = snapshot.get('groups/%s' % quote(name))
+    if group_info is None:
+        # A new group has no description or included groups, and owns
+        # itself.
+        yield Drift('group', name, 'exists', False, True)
+        group_info = {}
+        owner_info = dict(name=name)
+        included_infos = []
+    else:
+        path = 'groups/%s' % group_info['id']
+        owner_info = snapshot.get(path + '/owner')
+        included_infos = snapshot.get(path + '/groups')
+
+    description = params.get('description')
+    if description is not None and \
+            description != group_info.get('description', ''):
+        yield Drift('group', name, 'description',
+                    group_info.get('description', ''), description)
+
+    owner = params.get('owner')
+    if owner is not None and owner_info is not None and \
+            owner not in (owner_info.get('name'), owner_info.get('id')):
+        yield Drift('group', name, 'owner', owner_info.get('name'), owner)
+
+    if params.get('included_groups') is not None and \
+            included_infos is not None:
+        current = set(info['name'] for info in included_infos)
+        desired = non_empty(params['included_groups'])
+        if current != desired:
+            yield Drift('group', name, 'included_groups',
+                        sorted(current), sorted(desired))
+
+
+def project_drift(snapshot, params):
+    name = params['name']
+    config_info = snapshot.get('projects/%s/config' % quote(name))
+    if config_info is None:
+        yield Drift('project', name, 'exists', False, True)
+        config_info = {}
+
+    description = params.get('description')
+    if description is not None and \
+            description != config_info.get('description', ''):
+        yield Drift('project', name, 'description',
+                    config_info.get('description', ''), description)
+
+    state = params.get('state')
+    current_state = config_info.get('state', 'ACTIVE')
+    if state is not None and state.upper() != current_state:
+        yield Drift('project', name, 'state', current_state, state.upper())
+
+
+def inventory_drift(snapshot, inventory):
+    groups_by_account = snapshot.memberships.groups_by_account()
+    for params in inventory['accounts']:
+        for drift in account_drift(snapshot, params, groups_by_account):
+            yield drift
+    for params in inventory['groups']:
+        for drift in group_drift(snapshot, params):
+            yield drift
+    for params in inventory['projects']:
+        for drift in project_drift(snapshot, params):
+            yield drift
+
+
+def connect(args):
+    return common['gerrit_connection'](gerrit_url=args.gerrit_url)
+
+
+def cmd_export(args):
+    gerrit = connect(args)
+    snapshot = common['GerritSnapshot'].fetch(
+        gerrit, account_query=args.account_query, page_size=args.page_size,
+        workers=args.workers)
+    snapshot.save(args.snapshot)
+
+    # Anything in an old journal is included in the new snapshot.
+    if os.path.exists(args.snapshot + '.dirty'):
+        os.remove(args.snapshot + '.dirty')
+
+    logging.info("Saved %i entries to %s", len(snapshot), args.snapshot)
+
+
+def refresh_snapshot(args, snapshot, gerrit, event_keys=()):
+    journal_path = args.snapshot + '.dirty'
+    processing_path = journal_path + '.processing'
+
+    # Move the journal aside first, so that anything modules write while
+    # we're refreshing is kept for the next refresh.
+    if os.path.exists(journal_path):
+        os.rename(journal_path, processing_path)
+
+    keys = snapshot.dirty_keys(processing_path)
+    keys.update(event_keys)
+    for events_path in getattr(args, 'events', None) or []:
+        keys.update(snapshot.read_events(events_path))
+
+    logging.info("Refreshing %i objects", len(keys))
+    snapshot.refresh(gerrit, keys, workers=args.workers)
+    snapshot.save()
+
+    if os.path.exists(processing_path):
+        os.remove(processing_path)
+
+
+def cmd_refresh(args):
+    snapshot = common['GerritSnapshot'].load(args.snapshot,
+                                             ignore_journal=True)
+    refresh_snapshot(args, snapshot, connect(args))
+
+
+def read_event_stream(stream, lines, record_path=None):
+    '''Put each line of 'stream' on the 'lines' queue, with its offset.
+
+    The offset is the position in the record file after the line, so the
+    snapshot can note which of the recorded events it has already seen.
+
+    '''
+    record = open(record_path, 'ab') if record_path else None
+    try:
+        for line in iter(stream.readline, b''):
+            offset = None
+            if record:
+                record.write(line)
+                record.flush()
+                offset = record.tell()
+            lines.put((line, offset))
+    finally:
+        if record:
+            record.close()
+        lines.put((None, None))
+
+
+def cmd_follow(args):
+    snapshot = common['GerritSnapshot'].load(args.snapshot,
+                                             ignore_journal=True)
+    gerrit = connect(args)
+    record_path = os.path.abspath(args.record) if args.record else None
+
+    process = subprocess.Popen(shlex.split(args.command),
+                               stdout=subprocess.PIPE)
+    lines = queue.Queue()
+    reader = threading.Thread(target=read_event_stream,
+                              args=(process.stdout, lines, record_path))
+    reader.daemon = True
+    reader.start()
+
+    finished = False
+    while not finished:
+        deadline = time.time() + args.interval
+        keys = set()
+        while time.time() < deadline:
+            try:
+                line, offset = lines.get(
+                    timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if line is None:
+                finished = True
+                break
+            try:
+                event = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logging.warning("Ignoring invalid event: %r", line)
+                continue
+            keys.update(common['keys_changed_by_event'](event))
+            if record_path:
+                snapshot.event_offsets[record_path] = offset
+
+        if keys or os.path.exists(args.snapshot + '.dirty'):
+            refresh_snapshot(args, snapshot, gerrit, event_keys=keys)
+
+    return process.wait()
+
+
+def cmd_diff(args):
+    snapshot = common['GerritSnapshot'].load(args.snapshot)
+    inventory = load_inventory(args.inventory)
+
+    drift = list(inventory_drift(snapshot, inventory))
+    if args.json:
+        json.dump([d._asdict() for d in drift], sys.stdout, indent=4)
+        sys.stdout.write('\n')
+    else:
+        for d in drift:
+            print("%s %s: %s is %s, should be %s" % (
+                d.kind, d.name, d.field, json.dumps(d.current),
+                json.dumps(d.desired)))
+    return 1 if drift else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Save and compare snapshots of Gerrit's state")
+    parser.add_argument('--gerrit-url', help="URL of the Gerrit instance")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="number of concurrent requests (default: 8)")
+    parser.add_argument('--verbose', action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser(
+        'export', help="fetch everything from Gerrit into a new snapshot")
+    export_parser.add_argument('snapshot')
+    export_parser.add_argument(
+        '--account-query', default=common['ALL_ACCOUNTS_QUERY'],
+        help="which accounts to include (default: all of them)")
+    export_parser.add_argument('--page-size', type=int, default=500)
+    export_parser.set_defaults(function=cmd_export)
+
+    refresh_parser = subparsers.add_parser(
+        'refresh', help="fetch the objects the modules have changed again")
+    refresh_parser.add_argument('snapshot')
+    refresh_parser.add_argument(
+        '--events', action='append',
+        help="file of events from `gerrit stream-events` (can be repeated)")
+    refresh_parser.set_defaults(function=cmd_refresh)
+
+    follow_parser = subparsers.add_parser(
+        'follow', help="keep a snapshot up to date from Gerrit's events")
+    follow_parser.add_argument('snapshot')
+    follow_parser.add_argument(
+        '--command', required=True,
+        help="command that prints Gerrit events, e.g. `ssh -p 29418 "
+             "admin@gerrit gerrit stream-events`")
+    follow_parser.add_argument(
+        '--interval', type=float, default=10,
+        help="seconds between refreshes (default: 10)")
+    follow_parser.add_argument(
+        '--record', help="append the events to this file as well")
+    follow_parser.set_defaults(function=cmd_follow)
+
+    diff_parser = subparsers.add_parser(
+        'diff', help="compare a snapshot against an inventory file")
+    diff_parser.add_argument('snapshot')
+    diff_parser.add_argument('inventory')
+    diff_parser.add_argument('--json', action='store_true',
+                             help="output the differences as JSON")
+    diff_parser.set_defaults(function=cmd_diff)
+
+    args = parser.parse_args()
+    if not getattr(args, 'function', None):
+        parser.error("a command is required")
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
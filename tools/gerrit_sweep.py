@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Find the accounts, groups, projects and group members in Gerrit that aren't
+in an inventory.
+
+The modules only look at the objects that tasks name, so nothing ever notices
+an account that should have been removed. This lists everything in Gerrit
+with a few paged requests (the members of every group come with the list of
+groups), and compares it all against the inventory in memory.
+
+    tools/gerrit_sweep.py inventory.json
+    tools/gerrit_sweep.py inventory.json --deactivate-accounts \
+        --remove-members
+
+The inventory has the same format as for gerrit_snapshot.py. A member of a
+group in the inventory is unmanaged if the account isn't in the inventory, or
+if the account's 'groups' don't include that group. Groups such as
+Administrators and the system groups, the All-Projects and All-Users
+projects, and the admin account used for the sweep are never reported.
+
+With --deactivate-accounts, unmanaged accounts are made inactive, and with
+--remove-members, unmanaged members are removed from their groups. Groups and
+projects are only reported: removing them loses history, so that's left to a
+person.
+
+The exit status is 1 if anything unmanaged was found.
+
+'''
+
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import gerrit_snapshot
+from common_loader import load_common
+
+
+common = load_common()
+quote = common['quote']
+
+
+# Groups that every Gerrit instance has, which inventories don't list.
+BUILTIN_GROUPS = frozenset(['Administrators', 'Non-Interactive Users',
+                            'Service Users'])
+
+BUILTIN_PROJECTS = frozenset(['All-Projects', 'All-Users'])
+
+
+def is_builtin_group(info):
+    # System groups such as 'global:Registered-Users', and groups from other
+    # backends like LDAP, have a prefix in their UUID.
+    return info['name'] in BUILTIN_GROUPS or ':' in info['id']
+
+
+def desired_members(inventory):
+    '''Return group name -> usernames, and the usernames that list groups.'''
+    members = {}
+    managing = set()
+    for params in inventory['accounts']:
+        if params.get('groups') is None:
+            continue
+        managing.add(params['username'])
+        for group in gerrit_snapshot.non_empty(params['groups']):
+            members.setdefault(group, set()).add(params['username'])
+    return members, managing
+
+
+def sweep(gerrit, inventory, account_query='is:active', page_size=500,
+          ignore_usernames=()):
+    '''Yield (kind, name, info) for each unmanaged object.
+
+    'kind' is 'account', 'group', 'project' or 'member'. For members, 'name'
+    is (group name, username).
+
+    '''
+    iter_list = common['iter_list']
+
+    usernames = set(params['username'] for params in inventory['accounts'])
+    usernames.update(ignore_usernames)
+    accounts = iter_list(
+        gerrit, 'accounts/?q=%s&o=DETAILS' % quote(account_query),
+        page_size=page_size)
+    for info in accounts:
+        # Accounts without a username can't be named in an inventory.
+        username = info.get('username')
+        if username and username not in usernames:
+            yield 'account', username, info
+
+    group_names = set(params['name'] for params in inventory['groups'])
+    members, managing = desired_members(inventory)
+    for name, info in iter_list(gerrit, 'groups/?o=MEMBERS',
+                                page_size=page_size):
+        if is_builtin_group(info):
+            continue
+        if name not in group_names:
+            yield 'group', name, info
+            continue
+
+        wanted = members.get(name, set())
+        for member_info in info.get('members', []):
+            username = member_info.get('username')
+            if username in wanted or username in ignore_usernames:
+                continue
+            if username in managing or username not in usernames:
+                yield 'member', (name, username or
+                                 str(member_info['_account_id'])), \
+                    dict(group=info, account=member_info)
+
+    project_names = set(params['name'] for params in inventory['projects'])
+    for name, info in iter_list(gerrit, 'projects/', page_size=page_size):
+        if name not in project_names and name not in BUILTIN_PROJECTS:
+            yield 'project', name, info
+
+
+def describe(kind, name):
+    if kind == 'member':
+        return "unmanaged member %s of group %s" % (name[1], name[0])
+    return "unmanaged %s %s" % (kind, name)
+
+
+def remove_unmanaged(gerrit, found, deactivate_accounts, remove_members,
+                     workers):
+    '''Deactivate or remove what sweep() found, as asked.
+
+    Returns a list of (description, error) for the changes that failed.
+
+    '''
+    def action(item):
+        kind, name, info = item
+        if kind == 'account' and deactivate_accounts:
+            return 'accounts/%i/active' % info['_account_id']
+        if kind == 'member' and remove_members:
+            return 'groups/%s/members/%i' % (info['group']['id'],
+                                            info['account']['_account_id'])
+        return None
+
+    failures = []
+
+    def run(item):
+        path = action(item)
+        if path is None:
+            return
+        try:
+            gerrit.delete(path)
+            logging.info("Removed %s", describe(item[0], item[1]))
+        except Exception as e:
+            failures.append((describe(item[0], item[1]), str(e)))
+
+    common['run_in_threads'](run, found, workers)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find what's in Gerrit but not in an inventory")
+    parser.add_argument('inventory')
+    parser.add_argument('--gerrit-url', help="URL of the Gerrit instance")
+    parser.add_argument(
+        '--account-query', default='is:active',
+        help="which accounts to look at (default: is:active)")
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--deactivate-accounts', action='store_true',
+                        help="make unmanaged accounts inactive")
+    parser.add_argument('--remove-members', action='store_true',
+                        help="remove unmanaged members from their groups")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="number of concurrent requests (default: 8)")
+    parser.add_argument('--json', action='store_true',
+                        help="output what was found as JSON")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    inventory = gerrit_snapshot.load_inventory(args.inventory)
+    gerrit = common['gerrit_connection'](gerrit_url=args.gerrit_url)
+
+    # Never deactivate the account that is doing the sweep.
+    admin = os.environ.get('GERRIT_ADMIN_USERNAME')
+    found = list(sweep(gerrit, inventory, account_query=args.account_query,
+                       page_size=args.page_size,
+                       ignore_usernames=[admin] if admin else []))
+
+    if args.json:
+        json.dump([dict(kind=kind, name=name) for kind, name, info in found],
+                  sys.stdout, indent=4)
+        sys.stdout.write('\n')
+    else:
+        for kind, name, info in found:
+            print(describe(kind, name))
+
+    failures = []
+    if args.deactivate_accounts or args.remove_members:
+        failures = remove_unmanaged(gerrit, found, args.deactivate_accounts,
+                                    args.remove_members, args.workers)
+        for description, error in failures:
+            sys.stderr.write("Failed to remove %s: %s\n" % (description,
+                                                            error))
+
+    return 1 if found or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Long-lived worker process that runs ansible-gerrit tasks.
+
+Every Ansible task starts a new Python interpreter, imports pygerrit and
+requests, connects and authenticates to Gerrit, and then throws all of that
+away. This worker keeps those things around between tasks.
+
+Start it on the host where the modules run (usually the Ansible controller,
+with the tasks delegated to localhost):
+
+    make
+    tools/gerrit_worker.py --socket /tmp/gerrit-worker.sock &
+
+Then set the `gerrit_worker_socket` parameter (or the GERRIT_WORKER_SOCKET
+environment variable) for the gerrit_account, gerrit_group and gerrit_project
+tasks. The modules will forward their parameters over the socket and report
+whatever the worker sends back.
+
+The protocol is one line of JSON each way. The request looks like
+{"module": "gerrit_group", "params": {...}, "environ": {...}}, where "environ"
+holds the GERRIT_* variables from the task's environment. The reply is either
+{"output": {...}, "changed": true} or {"error": "message"}.
+
+Each connection is handled in its own thread. Connections to Gerrit are
+shared between threads, keyed on the URL, the credentials and the cache and
+snapshot settings, whether they came from the task's parameters or from its
+environment. The worker's own environment is not used for any of them.
+
+Before each task, the worker picks up any new events in the 'gerrit_events'
+file and any writes that other processes recorded in the snapshot's journal,
+so a snapshot loaded once stays up to date.
+
+'''
+
+
+import argparse
+import json
+import logging
+import os
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from common_loader import load_common
+
+
+MODULES = ['gerrit_account', 'gerrit_group', 'gerrit_project']
+
+def load_source(name, path):
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Worker(object):
+    def __init__(self, modules_dir):
+        self.modules_dir = modules_dir
+        self.modules = {}
+        self.connections = {}
+        self.lock = threading.Lock()
+
+        self.common = load_common(os.path.join(modules_dir, 'common.py'))
+
+    def module(self, name):
+        if name not in MODULES:
+            raise ValueError("Unknown module '%s'" % name)
+
+        with self.lock:
+            if name not in self.modules:
+                path = os.path.join(self.modules_dir, name + '.py')
+                logging.info("Loading module %s from %s", name, path)
+                self.modules[name] = load_source('gerrit_worker_' + name,
+                                                 path)
+            return self.modules[name]
+
+    def connection(self, params, environ):
+        # Settings the task didn't give come from the task's environment,
+        # never the worker's. Tasks that differ in any of them need their own
+        # connection.
+        connection_params = self.common['CONNECTION_PARAMS']
+        settings = dict(params)
+        for name, env_var in connection_params:
+            if settings.get(name) is None and env_var is not None:
+                settings[name] = environ.get(env_var)
+        key = tuple(settings.get(name) for name, env_var in connection_params)
+
+        with self.lock:
+            if key not in self.connections:
+                logging.info("Connecting to Gerrit at %s", key[0])
+                self.connections[key] = self.common['gerrit_connection'](
+                    environ=environ, **settings)
+            gerrit = self.connections[key]
+
+            snapshot = gerrit.snapshot
+            if snapshot is not None:
+                # The connection outlives many tasks, so look for changes made
+                # since the last one.
+                snapshot.invalidate(snapshot.dirty_keys())
+                if settings.get('gerrit_events'):
+                    snapshot.apply_events(settings['gerrit_events'])
+            return gerrit
+
+    def run(self, request):
+        module = self.module(request['module'])
+        params = request['params']
+        gerrit = self.connection(params, request.get('environ', {}))
+        output, changed = module.converge(gerrit, params)
+        return dict(output=output, changed=changed)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if len(line) == 0:
+            return
+
+        try:
+            request = json.loads(line.decode('utf-8'))
+            logging.info("Running %s task", request.get('module'))
+            response = self.server.worker.run(request)
+        except Exception as e:
+            logging.exception("Task failed")
+            response = dict(error=str(e))
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class WorkerServer(socketserver.ThreadingMixIn,
+                   socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, worker):
+        self.worker = worker
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               RequestHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run ansible-gerrit tasks in a long-lived process")
+    parser.add_argument('--socket', required=True,
+                        help="path of the Unix socket to listen on")
+    parser.add_argument(
+        '--modules-dir',
+        default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        help="directory containing common.py and the built modules")
+    parser.add_argument('--log-level', default='info',
+                        help="logging level (default: info)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s %(threadName)s %(message)s')
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    # The modules send the Gerrit admin credentials over the socket, so
+    # only the user running the worker may connect to it.
+    os.umask(0o077)
+
+    server = WorkerServer(args.socket, Worker(args.modules_dir))
+    logging.info("Listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()